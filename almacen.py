@@ -0,0 +1,127 @@
+# almacen.py
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from datetime import date
+
+from cache import compartido
+
+# Carpeta del almacén de constancias y espacio máximo que pueden ocupar los PDF
+ALMACEN_RAIZ = os.environ.get(
+    'ALMACEN_RAIZ',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'constancias_cache')
+)
+ALMACEN_MAX_BYTES = int(os.environ.get('ALMACEN_MAX_BYTES', str(200 * 1024 * 1024)))
+
+class AlmacenConstancias:
+    """
+    Almacén en disco de constancias descargadas, direccionado por contenido.
+
+    Cada PDF se guarda una sola vez en `blobs/` con su SHA-256 como nombre, y en
+    `claves/` un archivo por (fuente, RUC o DNI, fecha de vigencia) apunta a él.
+    Las constancias valen por el día: una clave de otra fecha nunca se consulta.
+    Si los PDF superan `max_bytes` se borran los usados hace más tiempo.
+    """
+    def __init__(self, raiz=ALMACEN_RAIZ, max_bytes=ALMACEN_MAX_BYTES):
+        self.raiz = raiz
+        self.max_bytes = max_bytes
+        self._blobs = os.path.join(raiz, 'blobs')
+        self._claves = os.path.join(raiz, 'claves')
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger('almacen')
+        os.makedirs(self._blobs, exist_ok=True)
+        os.makedirs(self._claves, exist_ok=True)
+
+    def _ruta_clave(self, fuente, identificador, fecha):
+        fecha = (fecha or date.today()).isoformat()
+        return os.path.join(self._claves, f"{fuente}_{identificador}_{fecha}")
+
+    def _ruta_blob(self, digest):
+        return os.path.join(self._blobs, f"{digest}.pdf")
+
+    def obtener(self, fuente, identificador, fecha=None):
+        """
+        Ruta del PDF guardado para la clave, o None si no hay uno vigente
+        """
+        try:
+            with open(self._ruta_clave(fuente, identificador, fecha), encoding='ascii') as f:
+                ruta = self._ruta_blob(f.read().strip())
+            # Marcar el uso para el desalojo por antigüedad
+            os.utime(ruta)
+            return ruta
+        except OSError:
+            return None
+
+    def guardar(self, fuente, identificador, ruta_pdf, fecha=None):
+        """
+        Copia el PDF al almacén (si su contenido no estaba ya) y lo asocia a la clave
+
+        Returns:
+            str: Ruta del PDF dentro del almacén
+        """
+        with open(ruta_pdf, 'rb') as f:
+            contenido = f.read()
+        digest = hashlib.sha256(contenido).hexdigest()
+        ruta = self._ruta_blob(digest)
+
+        with self._lock:
+            if not os.path.exists(ruta):
+                self._escribir(ruta, contenido)
+            else:
+                os.utime(ruta)
+            self._escribir(self._ruta_clave(fuente, identificador, fecha), digest.encode('ascii'))
+            self._desalojar(conservar=ruta)
+        return ruta
+
+    def _escribir(self, ruta, contenido):
+        # Escribir en un temporal y renombrar: nadie lee un archivo a medio escribir
+        fd, temporal = tempfile.mkstemp(dir=os.path.dirname(ruta))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(contenido)
+            os.replace(temporal, ruta)
+        except BaseException:
+            os.unlink(temporal)
+            raise
+
+    def _desalojar(self, conservar=None):
+        blobs = []
+        for entrada in os.scandir(self._blobs):
+            try:
+                estado = entrada.stat()
+            except OSError:
+                continue
+            blobs.append((estado.st_mtime, entrada.path, estado.st_size))
+
+        total = sum(tamano for *_, tamano in blobs)
+        eliminados = 0
+        for _, ruta, tamano in sorted(blobs):
+            if total <= self.max_bytes:
+                break
+            if ruta == conservar:
+                continue
+            os.unlink(ruta)
+            total -= tamano
+            eliminados += 1
+        if eliminados:
+            self.logger.info(f"Constancias desalojadas: {eliminados}")
+
+        # Borrar las claves vencidas y las que apuntan a PDF eliminados
+        hoy = date.today().isoformat()
+        for entrada in os.scandir(self._claves):
+            try:
+                if entrada.name.endswith(hoy):
+                    with open(entrada.path, encoding='ascii') as f:
+                        if os.path.exists(self._ruta_blob(f.read().strip())):
+                            continue
+                os.unlink(entrada.path)
+            except OSError:
+                pass
+
+def almacen_constancias():
+    """
+    Almacén de constancias compartido por todo el proceso
+    """
+    return compartido('almacen_constancias', AlmacenConstancias)
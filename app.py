@@ -1,52 +1,212 @@
 # app.py
 import streamlit as st
 import requests
-from rembg import remove
-from PIL import Image
+from PIL import Image, ImageOps
 import os
 from geopy.geocoders import Nominatim
 from streamlit_js_eval import get_geolocation
-import folium
-from streamlit_folium import st_folium
-import pdfplumber
 from docx import Document
 from docx.shared import Pt, Cm
 from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
+from docx.image.image import Image as DocxImage
 import re
+import copy
+import hashlib
+import threading
+import time
+import uuid
+from xml.sax.saxutils import escape as xml_escape
 from datetime import datetime
 from io import BytesIO
 import zipfile
 import pyperclip
 from st_copy_to_clipboard import st_copy_to_clipboard
-from streamlit_image_comparison import image_comparison
-from constancia import combinar_pdfs, setup_logging
+from constancia import descargar_constancias, preparar_combinacion, setup_logging
+from espacios import gestor_espacios
+from trazas import medido, traza, tramo
+from trabajos import CANCELADO, EN_CURSO, FALLIDO, HECHA, TERMINADO, cola_trabajos
+from cache import CacheLRU, compartido
+from empaque import escribir_zip
+from carga_diferida import diferido
 import logging
 setup_logging()
+
+# Dependencias pesadas: se importan en su primer uso (ver carga_diferida.py)
+remove = diferido('rembg', 'remove')
+rembg_sesiones = diferido('rembg.sessions')
+ort = diferido('onnxruntime')
+folium = diferido('folium')
+st_folium = diferido('streamlit_folium', 'st_folium')
+pdfplumber = diferido('pdfplumber')
+image_comparison = diferido('streamlit_image_comparison', 'image_comparison')
+
 # Determinar la ruta base de la aplicación
 base_dir = os.path.dirname(os.path.abspath(__file__))
 
-def obtener_datos_sunat(dni):
-    apisnet_key = st.secrets["APISNET"]["key"]
-    url = f"https://api.apis.net.pe/v2/sunat/dni?numero={dni}&token={apisnet_key}"
-    try:
-        response = requests.get(url)
+# Consulta de DNI en SUNAT: timeouts (conexión, lectura) y TTL del caché en segundos
+SUNAT_TIMEOUT = (3.05, 10)
+SUNAT_CACHE_TTL = 24 * 60 * 60
+SUNAT_CACHE_TTL_NEGATIVO = 10 * 60
+
+# Geocodificación inversa: grilla de cuantización en grados (~55 m), solicitudes por
+# segundo permitidas por Nominatim, timeout en segundos y límites del caché
+GEOCODER_GRILLA = 0.0005
+GEOCODER_TASA = 1.0
+GEOCODER_TIMEOUT = 10
+GEOCODER_CACHE_MAX_ENTRIES = 2048
+GEOCODER_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Cada cuánto se actualiza el avance de una cotización en segundo plano
+TRABAJO_SONDEO_S = 1.0
+
+# Límites del caché de extracción de TDR (compartido entre sesiones del proceso)
+TDR_CACHE_MAX_ENTRIES = 64
+TDR_CACHE_TTL = 60 * 60  # segundos
+# Motor de generación del DOCX: 'docx' (python-docx) o 'xml' (segmentos precompilados)
+MOTOR_COTIZACION = os.environ.get('MOTOR_COTIZACION', 'docx')
+# Longitud máxima por defecto (en caracteres normalizados) de una coincidencia desde su ancla
+TDR_SOLAPE_MAX = 2000
+# El objeto de la contratación puede ocupar varias páginas: su sección admite hasta
+# esta longitud; un objeto más largo se informa como "Servicio no encontrado"
+TDR_SERVICIO_MAX = int(os.environ.get('TDR_SERVICIO_MAX', '20000'))
+
+# Límites del caché de firmas procesadas (por hash de imagen y opciones)
+FIRMA_CACHE_MAX_ENTRIES = 32
+FIRMA_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Tamaño de la firma en el documento y resolución de la imagen que se inserta
+FIRMA_ALTO_CM = 1.91
+FIRMA_DPI = 300
+# Ancho de las vistas previas de la firma en la página
+FIRMA_MINIATURA_PX = 300
+# Modelo de rembg, inferencias simultáneas permitidas y precarga al iniciar la app
+REMBG_MODELO = os.environ.get('REMBG_MODELO', 'u2net')
+REMBG_MAX_INFERENCIAS = int(os.environ.get('REMBG_MAX_INFERENCIAS', '2'))
+REMBG_PRECARGAR = os.environ.get('REMBG_PRECARGAR', 'false').lower() == 'true'
+
+class ClienteSunat:
+    """
+    Cliente de la consulta de DNI de apis.net.pe.
+
+    Reutiliza una `requests.Session` (conexiones keep-alive), aplica timeouts de
+    conexión y lectura, y guarda en caché DNI -> (nombres, ruc). Los DNI que la
+    API rechaza también se guardan, con un TTL más corto.
+    """
+    URL = "https://api.apis.net.pe/v2/sunat/dni"
+
+    def __init__(self, timeout=None, ttl=None, ttl_negativo=None, max_entries=1024):
+        self.timeout = timeout or SUNAT_TIMEOUT
+        self.ttl_negativo = ttl_negativo or SUNAT_CACHE_TTL_NEGATIVO
+        self.cache = CacheLRU(max_entries=max_entries, ttl=ttl or SUNAT_CACHE_TTL)
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=10))
+
+    def consultar(self, dni, token):
+        """
+        Devuelve (nombres, ruc), o (None, None) si la API no reconoce el DNI
+
+        Raises:
+            requests.RequestException: Error de conexión, timeout o error del servidor
+        """
+        resultado = self.cache.get(dni)
+        if resultado is not None:
+            return resultado
+
+        with tramo('sunat'):
+            response = self.session.get(
+                self.URL, params={'numero': dni, 'token': token}, timeout=self.timeout
+            )
         if response.status_code == 200:
             data = response.json()
             nombres = f"{data.get('nombres', '')} {data.get('apellidoPaterno', '')} {data.get('apellidoMaterno', '')}".strip()
             ruc = data.get("ruc", "")
-            return nombres, ruc
+            resultado = (nombres, ruc)
+            self.cache.set(dni, resultado)
+        elif response.status_code == 429 or response.status_code >= 500:
+            # Errores pasajeros del servicio: no se guardan
+            response.raise_for_status()
         else:
+            resultado = (None, None)
+            self.cache.set(dni, resultado, ttl=self.ttl_negativo)
+        return resultado
+
+def cliente_sunat():
+    return compartido('sunat', ClienteSunat)
+
+def obtener_datos_sunat(dni):
+    apisnet_key = st.secrets["APISNET"]["key"]
+    try:
+        nombres, ruc = cliente_sunat().consultar(dni, apisnet_key)
+        if nombres is None:
             st.error("Error al obtener datos de SUNAT. Verifica el DNI ingresado.")
-            return None, None
+        return nombres, ruc
     except Exception as e:
         st.error(f"Error al conectar con la API de SUNAT: {e}")
         return None, None
 
+class LimitadorTasa:
+    """
+    Cubeta de fichas: permite `tasa` solicitudes por segundo con ráfagas de hasta `capacidad`
+    """
+    def __init__(self, tasa, capacidad=1):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self._fichas = capacidad
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def esperar(self):
+        """
+        Bloquea hasta que haya una ficha disponible y la consume
+        """
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._fichas = min(self.capacidad, self._fichas + (ahora - self._ultimo) * self.tasa)
+                self._ultimo = ahora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    return
+                espera = (1 - self._fichas) / self.tasa
+            time.sleep(espera)
+
+class GeocodificadorInverso:
+    """
+    Geocodificación inversa con Nominatim compartida por todo el proceso.
+
+    Las coordenadas se cuantizan a una grilla de `grilla` grados y cada celda se
+    consulta una sola vez (caché LRU con TTL). Las consultas respetan el límite de
+    Nominatim con una cubeta de fichas, y las consultas simultáneas de la misma
+    celda se agrupan en una sola.
+    """
+    def __init__(self, grilla=None, tasa=None, max_entries=None, ttl=None):
+        self.grilla = grilla or GEOCODER_GRILLA
+        self.geolocator = Nominatim(user_agent="my_streamlit_app", timeout=GEOCODER_TIMEOUT)
+        self.limitador = LimitadorTasa(tasa or GEOCODER_TASA)
+        self.cache = CacheLRU(
+            max_entries=max_entries or GEOCODER_CACHE_MAX_ENTRIES,
+            ttl=ttl or GEOCODER_CACHE_TTL,
+        )
+
+    def celda(self, lat, lon):
+        return (round(lat / self.grilla), round(lon / self.grilla))
+
+    def direccion(self, lat, lon):
+        def consultar():
+            self.limitador.esperar()
+            with tramo('geocodificacion'):
+                location = self.geolocator.reverse((lat, lon))
+            return location.address if location else None
+
+        return self.cache.obtener_o_calcular(self.celda(lat, lon), consultar)
+
+def geocodificador():
+    return compartido('geocodificador', GeocodificadorInverso)
+
 def obtener_direccion_desde_coordenadas(lat, lon):
-    geolocator = Nominatim(user_agent="my_streamlit_app")
     try:
-        location = geolocator.reverse((lat, lon))
-        return location.address
+        return geocodificador().direccion(lat, lon)
     except Exception as e:
         st.error(f"Error al obtener la dirección: {e}")
         return None
@@ -69,56 +229,266 @@ def crear_mapa(lat=None, lon=None, zoom=13):
 
     return m
 
-def extraer_nombre_servicio(pdf_file):
-    texto_completo = ""
-    with pdfplumber.open(pdf_file) as pdf:
-        for pagina in pdf.pages:
-            texto_completo += pagina.extract_text()
+def mapa_de_sesion():
+    """
+    Devuelve el mapa de la sesión, construyéndolo solo si cambió la ubicación o el zoom.
+
+    Reutilizar el mismo objeto mantiene los ids de folium y por lo tanto el mismo
+    HTML, así el navegador no vuelve a cargar el mapa en cada rerun.
+    """
+    clave = (st.session_state['lat'], st.session_state['lon'], st.session_state['zoom_mapa'])
+    guardado = st.session_state.get('_mapa')
+    if guardado is None or guardado[0] != clave:
+        guardado = (clave, crear_mapa(*clave))
+        st.session_state['_mapa'] = guardado
+    return guardado[1]
+
+def actualizar_ubicacion(lat, lon):
+    """
+    Mueve el marcador a (lat, lon) y actualiza la dirección geocodificada
+    """
+    st.session_state['lat'] = lat
+    st.session_state['lon'] = lon
+    # El mapa nuevo se centra con el zoom que el usuario tenga en ese momento
+    st.session_state['zoom_mapa'] = st.session_state['zoom']
+    direccion = obtener_direccion_desde_coordenadas(lat, lon)
+    if direccion:
+        st.session_state['direccion'] = direccion
+
+def procesar_clic_mapa(mapa_data):
+    """
+    Aplica el último clic del mapa una sola vez.
 
-    texto_unido = ' '.join(texto_completo.split())
+    st_folium solo informa el clic más reciente, así que una ráfaga de clics se
+    reduce a la última posición.
 
-    patron = r'2\.\s*OBJETO\s*DE\s*LA\s*CONTRATACION\s*(.*?)\s*3\.\s*FINALIDAD\s*PUBLICA'
+    Returns:
+        bool: True si la ubicación cambió (hay que volver a dibujar el mapa)
+    """
+    if not mapa_data:
+        return False
 
-    match = re.search(patron, texto_unido, re.DOTALL | re.IGNORECASE)
+    # El zoom del usuario se recuerda, pero por sí solo no redibuja el mapa
+    if mapa_data.get("zoom"):
+        st.session_state['zoom'] = mapa_data["zoom"]
 
-    if match:
-        servicio = ' '.join(match.group(1).split())
-        return servicio
-    return "Servicio no encontrado"
+    clic = mapa_data.get("last_clicked")
+    if not clic:
+        return False
+    posicion = (clic["lat"], clic["lng"])
+    if posicion == st.session_state.get('ultimo_clic'):
+        return False
 
-def extraer_forma_pago(pdf_file):
-    texto_completo = ""
-    with pdfplumber.open(pdf_file) as pdf:
-        for pagina in pdf.pages:
-            texto_completo += pagina.extract_text()
+    st.session_state['ultimo_clic'] = posicion
+    actualizar_ubicacion(*posicion)
+    return True
 
-    texto_unido = ' '.join(texto_completo.split())
+class TdrDocument:
+    """
+    Campos extraídos de un TDR en una sola lectura del PDF
+    """
+    def __init__(self, **campos):
+        self.campos = campos
 
-    patron = r'El pago se realizará en\s*(.*?)\s*luego de la emisión de la conformidad del servicio,'
+    def __getattr__(self, nombre):
+        try:
+            return self.__dict__['campos'][nombre]
+        except KeyError:
+            raise AttributeError(nombre) from None
 
-    match = re.search(patron, texto_unido, re.DOTALL | re.IGNORECASE)
+    def __repr__(self):
+        campos = ', '.join(f"{nombre}={valor!r}" for nombre, valor in self.campos.items())
+        return f"TdrDocument({campos})"
 
-    if match:
-        forma_pago = ' '.join(match.group(1).split()).upper()
-        return forma_pago
-    return "FORMA DE PAGO NO ENCONTRADA"
+class CampoTdr:
+    """
+    Especificación declarativa de un campo a extraer del TDR.
 
-def extraer_dias(pdf_file):
-    texto_completo = ""
+    Args:
+        nombre: Nombre del campo en TdrDocument
+        ancla: Texto literal que toda coincidencia contiene; se busca primero
+            (sin distinguir mayúsculas) para ubicar las ventanas candidatas
+        patron: Expresión regular del campo, evaluada solo dentro de la ventana
+        postproceso: Función que recibe el match y devuelve el valor
+        default: Valor si el campo no aparece en el TDR
+        retroceso: Caracteres que la coincidencia puede empezar antes del ancla
+        max_longitud: Longitud máxima de una coincidencia desde el ancla
+    """
+    def __init__(self, nombre, ancla, patron, postproceso=None, default=None,
+                 retroceso=0, max_longitud=None):
+        self.nombre = nombre
+        self.ancla = ancla
+        self.ancla_re = re.compile(re.escape(ancla), re.IGNORECASE)
+        self.patron = re.compile(patron, re.IGNORECASE)
+        self.postproceso = postproceso or (lambda match: match.group(1))
+        self.default = default
+        self.retroceso = retroceso
+        self.max_longitud = max_longitud or TDR_SOLAPE_MAX
+
+def _normalizar_grupo(match):
+    return ' '.join(match.group(1).split())
+
+# Registro de campos del TDR. Agregar un campo es agregar una entrada aquí; se
+# evalúa en el mismo recorrido de páginas que los demás.
+CAMPOS_TDR = {campo.nombre: campo for campo in [
+    CampoTdr(
+        'servicio',
+        ancla='OBJETO',
+        patron=r'2\.\s*OBJETO\s*DE\s*LA\s*CONTRATACION\s*(.*?)\s*3\.\s*FINALIDAD\s*PUBLICA',
+        postproceso=_normalizar_grupo,
+        default="Servicio no encontrado",
+        retroceso=len("2. "),
+        max_longitud=TDR_SERVICIO_MAX,
+    ),
+    CampoTdr(
+        'forma_pago',
+        ancla='El pago se realizará en',
+        patron=r'El pago se realizará en\s*(.*?)\s*luego de la emisión de la conformidad del servicio,',
+        postproceso=lambda match: _normalizar_grupo(match).upper(),
+        default="FORMA DE PAGO NO ENCONTRADA",
+    ),
+    CampoTdr(
+        'dias',
+        ancla='El plazo de ejecución del servicio es de hasta',
+        patron=r'El plazo de ejecución del servicio es de hasta\s*(\d+)\s*días calendario',
+        default="DÍAS NO ENCONTRADOS",
+    ),
+]}
+
+def iterar_paginas_tdr(pdf_file):
+    """
+    Genera el texto normalizado de cada página del TDR, una página a la vez
+    """
     with pdfplumber.open(pdf_file) as pdf:
         for pagina in pdf.pages:
-            texto_completo += pagina.extract_text()
+            texto = ' '.join((pagina.extract_text() or "").split())
+            # Liberar los objetos de la página ya procesada
+            pagina.close()
+            yield texto
+
+def _evaluar_campo(campo, texto, desde):
+    """
+    Busca el campo en el texto a partir de `desde` usando su ancla literal.
 
-    texto_unido = ' '.join(texto_completo.split())
+    Returns:
+        tuple: (match o None, nueva posición desde la que seguir buscando)
+    """
+    while True:
+        ancla = campo.ancla_re.search(texto, desde)
+        if ancla is None:
+            # El ancla aún puede aparecer partida entre esta página y la siguiente
+            return None, max(desde, len(texto) - len(campo.ancla) + 1)
+
+        inicio = max(0, ancla.start() - campo.retroceso)
+        fin = ancla.start() + campo.max_longitud
+        match = campo.patron.search(texto, inicio, min(fin, len(texto)))
+        if match:
+            return match, desde
+        if fin > len(texto):
+            # La ventana está incompleta: esperar a la siguiente página
+            return None, ancla.start()
+        desde = ancla.start() + 1
+
+def extraer_campos_tdr(pdf_file, campos=None):
+    """
+    Evalúa los campos del registro en un solo recorrido del TDR, página a página.
 
-    patron = r'El plazo de ejecución del servicio es de hasta\s*(\d+)\s*días calendario'
+    Cada campo ubica primero su ancla literal y solo ejecuta su expresión regular
+    en la ventana que empieza ahí, nunca sobre el documento completo. La lectura
+    se detiene en cuanto todos los campos están resueltos; para las coincidencias
+    que cruzan el borde entre páginas se conserva el texto desde la última ancla
+    pendiente.
 
-    match = re.search(patron, texto_unido, re.DOTALL | re.IGNORECASE)
+    Args:
+        pdf_file: Ruta o archivo PDF
+        campos: Nombres de CAMPOS_TDR a extraer (por defecto, todos)
 
-    if match:
-        dias = match.group(1)
-        return dias
-    return "DÍAS NO ENCONTRADOS"
+    Returns:
+        dict: Valor de cada campo, o su valor por defecto si no se encontró
+    """
+    campos = list(CAMPOS_TDR) if campos is None else list(campos)
+    pendientes = [CAMPOS_TDR[nombre] for nombre in campos]
+    resultados = {}
+    # Posición del texto acumulado desde la que se sigue buscando el ancla de cada campo
+    desde = {campo.nombre: 0 for campo in pendientes}
+    texto = ""
+
+    paginas = iterar_paginas_tdr(pdf_file)
+    try:
+        for pagina in paginas:
+            texto = f"{texto} {pagina}" if texto else pagina
+
+            for campo in list(pendientes):
+                match, desde[campo.nombre] = _evaluar_campo(campo, texto, desde[campo.nombre])
+                if match:
+                    resultados[campo.nombre] = campo.postproceso(match)
+                    pendientes.remove(campo)
+
+            if not pendientes:
+                break
+
+            # Descartar el texto que ya no puede formar parte de ninguna coincidencia
+            recorte = min(max(0, desde[campo.nombre] - campo.retroceso) for campo in pendientes)
+            if recorte > 0:
+                texto = texto[recorte:]
+                for campo in pendientes:
+                    desde[campo.nombre] -= recorte
+    finally:
+        paginas.close()
+
+    return {
+        nombre: resultados.get(nombre, CAMPOS_TDR[nombre].default)
+        for nombre in campos
+    }
+
+def _leer_bytes(archivo):
+    # Obtener el contenido del archivo sin importar si es ruta, UploadedFile o BytesIO
+    if isinstance(archivo, (str, os.PathLike)):
+        with open(archivo, 'rb') as f:
+            return f.read()
+    if hasattr(archivo, 'getvalue'):
+        return archivo.getvalue()
+    archivo.seek(0)
+    contenido = archivo.read()
+    archivo.seek(0)
+    return contenido
+
+def _cache_tdr():
+    return compartido('tdr', lambda: CacheLRU(max_entries=TDR_CACHE_MAX_ENTRIES, ttl=TDR_CACHE_TTL))
+
+def parse_tdr(pdf_file):
+    """
+    Extrae servicio, forma de pago y días de un TDR abriendo el PDF una sola vez.
+
+    El resultado se guarda en un caché LRU con TTL indexado por el SHA-256 del
+    contenido, de modo que cada archivo se analiza una sola vez por proceso sin
+    importar cuántas reejecuciones o usuarios lo suban.
+
+    Args:
+        pdf_file: Ruta o archivo PDF subido
+
+    Returns:
+        TdrDocument: Campos extraídos del TDR
+    """
+    contenido = _leer_bytes(pdf_file)
+    sha256 = hashlib.sha256(contenido).hexdigest()
+
+    cache = _cache_tdr()
+    tdr = cache.get(sha256)
+    if tdr is None:
+        with tramo('tdr'):
+            tdr = TdrDocument(**extraer_campos_tdr(BytesIO(contenido)))
+        cache.set(sha256, tdr)
+    return tdr
+
+def extraer_nombre_servicio(pdf_file):
+    return parse_tdr(pdf_file).servicio
+
+def extraer_forma_pago(pdf_file):
+    return parse_tdr(pdf_file).forma_pago
+
+def extraer_dias(pdf_file):
+    return parse_tdr(pdf_file).dias
 
 def obtener_valor_sugerido(dias):
     """
@@ -139,6 +509,169 @@ def obtener_valor_sugerido(dias):
     except (ValueError, TypeError):
         return 2000.0  # Valor por defecto si hay error en la conversión
 
+class ServicioRemoverFondo:
+    """
+    Sesión de rembg compartida por todo el proceso.
+
+    El modelo se carga una sola vez en un hilo de fondo y todas las sesiones de
+    Streamlit lo reutilizan. Un semáforo limita las inferencias simultáneas y
+    cada una usa su parte de los núcleos, así una ráfaga de firmas no satura la
+    CPU ni multiplica la memoria.
+    """
+    def __init__(self, modelo, max_inferencias):
+        self.modelo = modelo
+        self.max_inferencias = max_inferencias
+        self._semaforo = threading.BoundedSemaphore(max_inferencias)
+        self._lock = threading.Lock()
+        self._carga = None
+        self._sesion = None
+        self._error = None
+
+    def precargar(self):
+        """
+        Inicia la carga del modelo en segundo plano si aún no empezó
+        """
+        with self._lock:
+            if self._carga is None:
+                self._carga = threading.Thread(
+                    target=self._cargar, name='rembg-precarga', daemon=True
+                )
+                self._carga.start()
+            return self._carga
+
+    def _cargar(self):
+        logger = logging.getLogger('rembg')
+        try:
+            sess_opts = ort.SessionOptions()
+            hilos = max(1, (os.cpu_count() or 1) // self.max_inferencias)
+            sess_opts.intra_op_num_threads = hilos
+            sess_opts.inter_op_num_threads = 1
+
+            session_class = next(
+                (sc for sc in rembg_sesiones.sessions_class if sc.name() == self.modelo),
+                rembg_sesiones.U2netSession,
+            )
+            self._sesion = session_class(self.modelo, sess_opts, None)
+            logger.info(f"Modelo {self.modelo} de rembg cargado ({hilos} hilos por inferencia)")
+        except Exception as e:
+            logger.error(f"Error al cargar el modelo {self.modelo} de rembg: {e}")
+            self._error = e
+
+    def sesion(self):
+        """
+        Devuelve la sesión cargada, esperando la precarga si está en curso
+        """
+        self.precargar().join()
+        if self._sesion is None:
+            with self._lock:
+                # Permitir reintentar la carga en la próxima llamada
+                self._carga = None
+            raise RuntimeError(f"No se pudo cargar el modelo de rembg: {self._error}")
+        return self._sesion
+
+    def remover(self, imagen):
+        sesion = self.sesion()
+        with self._semaforo, tramo('rembg'):
+            return remove(imagen, session=sesion)
+
+def servicio_remover_fondo():
+    return compartido(
+        'rembg', lambda: ServicioRemoverFondo(REMBG_MODELO, REMBG_MAX_INFERENCIAS)
+    )
+
+class FirmaProcesada:
+    """
+    Imágenes derivadas de una firma subida
+
+    Attributes:
+        embebida: PNG optimizado a FIRMA_DPI para FIRMA_ALTO_CM de alto (va al DOCX y al ZIP)
+        miniatura: PNG de vista previa de la firma procesada
+        miniatura_original: PNG de vista previa de la imagen subida, del mismo tamaño
+        original: Bytes de la imagen subida, solo si se pidió conservarla
+    """
+    def __init__(self, embebida, miniatura, miniatura_original, original=None):
+        self.embebida = embebida
+        self.miniatura = miniatura
+        self.miniatura_original = miniatura_original
+        self.original = original
+
+    def peso(self):
+        return sum(len(datos) for datos in (
+            self.embebida, self.miniatura, self.miniatura_original, self.original
+        ) if datos)
+
+def _cache_firmas():
+    return compartido('firmas', lambda: CacheLRU(
+        max_entries=FIRMA_CACHE_MAX_ENTRIES, max_bytes=FIRMA_CACHE_MAX_BYTES,
+        peso=FirmaProcesada.peso,
+    ))
+
+def _a_png(imagen, dpi=None):
+    img_byte_arr = BytesIO()
+    if dpi:
+        imagen.save(img_byte_arr, format='PNG', optimize=True, dpi=(dpi, dpi))
+    else:
+        imagen.save(img_byte_arr, format='PNG', optimize=True)
+    return img_byte_arr.getvalue()
+
+def preparar_firma(firma_file, remover_fondo=False, conservar_original=False):
+    """
+    Genera la imagen de firma a insertar y sus vistas previas.
+
+    La imagen se orienta según su EXIF y se reduce al alto en píxeles que necesita
+    FIRMA_ALTO_CM a FIRMA_DPI antes de remover el fondo, de modo que ni rembg ni el
+    DOCX ni el ZIP cargan con los 12 MP de una foto de celular. El resultado se
+    guarda en caché por el SHA-256 de la imagen y las opciones, así el modelo de
+    rembg corre una sola vez por firma.
+
+    Args:
+        firma_file: Archivo de imagen subido
+        remover_fondo: Boolean indicando si se debe remover el fondo
+        conservar_original: Guardar también los bytes de la imagen subida
+
+    Returns:
+        FirmaProcesada: Imagen a insertar y vistas previas
+    """
+    contenido = _leer_bytes(firma_file)
+    clave = (hashlib.sha256(contenido).hexdigest(), remover_fondo, conservar_original)
+
+    cache = _cache_firmas()
+    firma = cache.get(clave)
+    if firma is None:
+        # Abrir la imagen respetando la orientación de la cámara
+        image = ImageOps.exif_transpose(Image.open(BytesIO(contenido)))
+
+        # Reducir al tamaño con el que se imprime en el documento
+        alto_px = round(FIRMA_ALTO_CM / 2.54 * FIRMA_DPI)
+        if image.height > alto_px:
+            ancho_px = max(1, round(image.width * alto_px / image.height))
+            image = image.resize((ancho_px, alto_px), Image.LANCZOS)
+
+        if remover_fondo:
+            with st.spinner('Removiendo fondo de la firma...'):
+                # Remover fondo con la sesión compartida
+                imagen_procesada = servicio_remover_fondo().remover(image)
+                # Convertir a modo RGBA si no lo está ya
+                if imagen_procesada.mode != 'RGBA':
+                    imagen_procesada = imagen_procesada.convert('RGBA')
+        else:
+            imagen_procesada = image
+
+        # Vistas previas del mismo tamaño para el comparador
+        miniatura_original = image.copy()
+        miniatura_original.thumbnail((FIRMA_MINIATURA_PX, FIRMA_MINIATURA_PX), Image.LANCZOS)
+        miniatura = imagen_procesada.resize(miniatura_original.size, Image.LANCZOS)
+
+        firma = FirmaProcesada(
+            embebida=_a_png(imagen_procesada, dpi=FIRMA_DPI),
+            miniatura=_a_png(miniatura),
+            miniatura_original=_a_png(miniatura_original),
+            original=contenido if conservar_original else None,
+        )
+        cache.set(clave, firma)
+
+    return firma
+
 def procesar_firma(firma_file, remover_fondo=False):
     """
     Procesa la imagen de la firma, opcionalmente removiendo el fondo.
@@ -150,25 +683,7 @@ def procesar_firma(firma_file, remover_fondo=False):
     Returns:
         BytesIO: Imagen procesada en formato BytesIO
     """
-    # Abrir la imagen
-    image = Image.open(firma_file)
-    
-    if remover_fondo:
-        with st.spinner('Removiendo fondo de la firma...'):
-            # Remover fondo
-            imagen_procesada = remove(image)
-            # Convertir a modo RGBA si no lo está ya
-            if imagen_procesada.mode != 'RGBA':
-                imagen_procesada = imagen_procesada.convert('RGBA')
-    else:
-        imagen_procesada = image
-        
-    # Convertir a BytesIO
-    img_byte_arr = BytesIO()
-    imagen_procesada.save(img_byte_arr, format='PNG')
-    img_byte_arr.seek(0)
-    
-    return img_byte_arr
+    return BytesIO(preparar_firma(firma_file, remover_fondo).embebida)
 
 def mostrar_seccion_firma():
     """
@@ -182,6 +697,9 @@ def mostrar_seccion_firma():
     
     # Checkbox para remover fondo
     remover_fondo = st.checkbox("Remover fondo de la firma", value=False)
+    if remover_fondo:
+        # Ir cargando el modelo mientras se sube la imagen
+        servicio_remover_fondo().precargar()
     
     # Upload de firma
     firma_file = st.file_uploader(
@@ -192,141 +710,366 @@ def mostrar_seccion_firma():
     
     if firma_file is not None:
         # Procesar firma
-        firma_procesada = procesar_firma(firma_file, remover_fondo)
+        firma = preparar_firma(firma_file, remover_fondo)
+        firma_procesada = BytesIO(firma.embebida)
         
         if remover_fondo:
             # Mostrar comparación antes/después
             col1, col2 = st.columns(2)
             with col1:
                 st.write("Firma Original")
-                st.image(firma_file, width=300)
+                st.image(firma.miniatura_original, width=FIRMA_MINIATURA_PX)
             with col2:
                 st.write("Firma sin fondo")
-                st.image(firma_procesada, width=300)
+                st.image(firma.miniatura, width=FIRMA_MINIATURA_PX)
                 
             # Opcionalmente mostrar comparador deslizante
             st.write("Comparador deslizante")
             image_comparison(
-                img1=Image.open(firma_file),
-                img2=Image.open(firma_procesada),
+                img1=Image.open(BytesIO(firma.miniatura_original)),
+                img2=Image.open(BytesIO(firma.miniatura)),
                 label1="Original",
                 label2="Sin fondo"
             )
         else:
             # Mostrar solo la firma original
-            st.image(firma_file, caption="Vista previa de la firma", width=300)
+            st.image(firma.miniatura_original, caption="Vista previa de la firma", width=FIRMA_MINIATURA_PX)
         
         return firma_procesada, True
     
     return None, False
 
-def generar_cotizacion(pdf_file, data):
-    # Extraer datos del PDF
-    servicio = extraer_nombre_servicio(pdf_file)
-    forma_pago = extraer_forma_pago(pdf_file)
-    dias = extraer_dias(pdf_file)
+# Marcadores de la plantilla: {{fecha}}, {{servicio}}, {{firma}}, ...
+PATRON_MARCADOR = re.compile(r'\{\{(\w+)\}\}')
+
+class PlantillaCotizacion:
+    """
+    Plantilla de cotización cargada una sola vez, con el índice de los párrafos
+    que contienen marcadores.
+
+    El índice guarda la posición de cada párrafo entre los `w:p` del cuerpo y los
+    marcadores que contiene, de modo que en cada cotización solo se recorren esos
+    párrafos sobre una copia del documento ya cargado.
+    """
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.mtime = os.path.getmtime(ruta)
+        self.documento = Document(ruta)
+        self.indice = self._indexar_marcadores()
+        self._xml = None
+        self._lock = threading.Lock()
+
+    def _indexar_marcadores(self):
+        posiciones = {p: i for i, p in enumerate(self.documento.element.body.iter(qn('w:p')))}
+        indice = {}
+
+        def registrar(paragraph):
+            marcadores = set(PATRON_MARCADOR.findall(paragraph.text))
+            if marcadores:
+                indice[posiciones[paragraph._p]] = frozenset(marcadores)
+
+        # Los mismos párrafos que recorría la versión anterior: cuerpo y tablas anidadas
+        def recorrer_tabla(tabla):
+            for row in tabla.rows:
+                for cell in row.cells:
+                    for paragraph in cell.paragraphs:
+                        registrar(paragraph)
+                    for tabla_anidada in cell.tables:
+                        recorrer_tabla(tabla_anidada)
+
+        for paragraph in self.documento.paragraphs:
+            registrar(paragraph)
+        for tabla in self.documento.tables:
+            recorrer_tabla(tabla)
+
+        return sorted(indice.items())
+
+    def nuevo_documento(self):
+        """
+        Devuelve una copia del documento y sus párrafos indexados con sus marcadores
+        """
+        doc = copy.deepcopy(self.documento)
+        parrafos = list(doc.element.body.iter(qn('w:p')))
+        return doc, [
+            (Paragraph(parrafos[posicion], doc._body), marcadores)
+            for posicion, marcadores in self.indice
+        ]
+
+    def compilar_xml(self):
+        """
+        Devuelve la plantilla precompilada para el motor XML, compilándola la primera vez
+        """
+        with self._lock:
+            if self._xml is None:
+                self._xml = PlantillaXml(self)
+            return self._xml
+
+# Delimitadores de los marcadores ya fusionados en la plantilla XML (caracteres de
+# uso privado, que no aparecen en el texto de la plantilla)
+_INICIO_MARCADOR = '\ue000'
+_FIN_MARCADOR = '\ue001'
+_PATRON_SEGMENTO = re.compile(
+    ('<w:t>' + _INICIO_MARCADOR + 'firma' + _FIN_MARCADOR + '</w:t>|'
+     + _INICIO_MARCADOR + r'(\w+)' + _FIN_MARCADOR).encode('utf-8')
+)
+
+_TIPO_IMAGEN = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/image'
+
+# Mismo XML que genera python-docx con run.add_picture()
+_DRAWING_FIRMA = (
+    '<w:drawing><wp:inline xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+    'xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+    '<wp:extent cx="{cx}" cy="{cy}"/><wp:docPr id="{id}" name="Picture {id}"/>'
+    '<wp:cNvGraphicFramePr><a:graphicFrameLocks noChangeAspect="1"/></wp:cNvGraphicFramePr>'
+    '<a:graphic><a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+    '<pic:pic><pic:nvPicPr><pic:cNvPr id="0" name="{nombre}"/><pic:cNvPicPr/></pic:nvPicPr>'
+    '<pic:blipFill><a:blip r:embed="{rid}"/><a:stretch><a:fillRect/></a:stretch></pic:blipFill>'
+    '<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{cx}" cy="{cy}"/></a:xfrm>'
+    '<a:prstGeom prst="rect"/></pic:spPr></pic:pic></a:graphicData></a:graphic>'
+    '</wp:inline></w:drawing>'
+)
+
+class PlantillaXml:
+    """
+    Plantilla precompilada para el motor XML.
+
+    Al compilar se fusionan una sola vez los runs de cada párrafo con marcadores
+    (igual que lo hace el motor python-docx en cada cotización) y `word/document.xml`
+    queda partido en segmentos de bytes entre marcadores. Cada cotización solo une
+    esos segmentos con los valores escapados y agrega la imagen de la firma.
+    """
+    def __init__(self, plantilla):
+        doc, parrafos_con_marcadores = plantilla.nuevo_documento()
+        for paragraph, marcadores in parrafos_con_marcadores:
+            if 'firma' in marcadores:
+                paragraph._element.clear_content()
+                paragraph.add_run(_INICIO_MARCADOR + 'firma' + _FIN_MARCADOR)
+            else:
+                run = _fusionar_runs(paragraph, {})
+                run.text = PATRON_MARCADOR.sub(_INICIO_MARCADOR + r'\1' + _FIN_MARCADOR, run.text)
+                # El valor final puede empezar o terminar con espacios
+                for t in run._r.t_lst:
+                    t.set(qn('xml:space'), 'preserve')
+
+        self.siguiente_id = doc.part.next_id
+        self.segmentos = self._partir(doc.part.blob)
+
+        with zipfile.ZipFile(plantilla.ruta) as zipf:
+            self.partes = [(nombre, zipf.read(nombre)) for nombre in zipf.namelist()]
+        self._nombres = {nombre for nombre, _ in self.partes}
+
+        # Primer rId libre, como lo elige python-docx
+        rels = dict(self.partes)['word/_rels/document.xml.rels']
+        usados = {int(n) for n in re.findall(rb'Id="rId(\d+)"', rels)}
+        self.rid_firma = 'rId%d' % next(n for n in range(1, len(usados) + 2) if n not in usados)
+
+    @staticmethod
+    def _partir(xml):
+        # Alterna bytes literales con el nombre del marcador (None para la firma)
+        segmentos = []
+        posicion = 0
+        for match in _PATRON_SEGMENTO.finditer(xml):
+            segmentos.append(xml[posicion:match.start()])
+            segmentos.append(match.group(1).decode('utf-8') if match.group(1) else None)
+            posicion = match.end()
+        segmentos.append(xml[posicion:])
+        return segmentos
+
+    def _nombre_imagen(self, extension):
+        n = 1
+        while f'word/media/image{n}.{extension}' in self._nombres:
+            n += 1
+        return f'word/media/image{n}.{extension}'
+
+    def renderizar(self, reemplazos, firma_blob):
+        """
+        Genera el DOCX con los valores de `reemplazos` (por nombre de marcador)
+
+        Returns:
+            BytesIO: Documento generado
+        """
+        imagen = DocxImage.from_blob(firma_blob)
+        cx, cy = imagen.scaled_dimensions(height=Cm(FIRMA_ALTO_CM))
+        parte_imagen = self._nombre_imagen(imagen.ext)
+
+        partes_xml = []
+        id_firma = self.siguiente_id
+        for i, segmento in enumerate(self.segmentos):
+            if i % 2 == 0:
+                partes_xml.append(segmento)
+            elif segmento is None:
+                partes_xml.append(_DRAWING_FIRMA.format(
+                    cx=cx, cy=cy, id=id_firma, nombre=imagen.filename, rid=self.rid_firma
+                ).encode('utf-8'))
+                id_firma += 1
+            elif segmento in reemplazos:
+                partes_xml.append(_texto_xml(str(reemplazos[segmento])).encode('utf-8'))
+            else:
+                partes_xml.append(('{{%s}}' % segmento).encode('utf-8'))
+
+        doc_io = BytesIO()
+        with zipfile.ZipFile(doc_io, mode='w', compression=zipfile.ZIP_DEFLATED) as zipf:
+            for nombre, contenido in self.partes:
+                if nombre == 'word/document.xml':
+                    contenido = b''.join(partes_xml)
+                elif nombre == 'word/_rels/document.xml.rels':
+                    relacion = (
+                        f'<Relationship Id="{self.rid_firma}" Type="{_TIPO_IMAGEN}" '
+                        f'Target="{parte_imagen[len("word/"):]}"/>'
+                    ).encode('utf-8')
+                    contenido = contenido.replace(b'</Relationships>', relacion + b'</Relationships>')
+                elif nombre == '[Content_Types].xml':
+                    extension = f'Extension="{imagen.ext}"'.encode('utf-8')
+                    if extension not in contenido:
+                        default = f'<Default {extension.decode()} ContentType="{imagen.content_type}"/>'
+                        contenido = contenido.replace(b'</Types>', default.encode('utf-8') + b'</Types>')
+                zipf.writestr(nombre, contenido)
+            zipf.writestr(parte_imagen, firma_blob)
+
+        doc_io.seek(0)
+        return doc_io
+
+def _texto_xml(texto):
+    # Escapar el valor y convertir tabulaciones y saltos como lo hace python-docx
+    texto = xml_escape(texto)
+    texto = texto.replace('\t', '</w:t><w:tab/><w:t xml:space="preserve">')
+    return re.sub(r'\r\n?|\n', '</w:t><w:br/><w:t xml:space="preserve">', texto)
+
+def obtener_plantilla(template_path):
+    """
+    Devuelve la plantilla compilada, recargándola solo si cambió su mtime
+    """
+    plantillas = compartido('plantillas', lambda: CacheLRU(max_entries=8))
+    plantilla = plantillas.get(template_path)
+    if plantilla is None or plantilla.mtime != os.path.getmtime(template_path):
+        plantilla = PlantillaCotizacion(template_path)
+        plantillas.set(template_path, plantilla)
+    return plantilla
+
+def _reemplazos_cotizacion(data):
+    # Valor de cada marcador de la plantilla, por nombre
+    return {
+        'fecha': data['fecha'],
+        'servicio': data['servicio'],
+        'dias': data['dias'],
+        'oferta': "{:.2f}".format(data['oferta']),
+        'armada': data['armada'],
+        'MES': data['mes'],
+        'dni': data['dni'],
+        'nombres': data['nombres'],
+        'ruc': data['ruc'],
+        'telefono': data['telefono'],
+        'correo': data['correo'],
+        'direccion': data['direccion'],
+        'banco': data['banco'],
+        'cuenta': data['cuenta'],
+        'cci': data['cci'],
+        'year': str(data['year']),
+    }
+
+def reemplazar_texto(texto, reemplazos):
+    for key, value in reemplazos.items():
+        texto = texto.replace('{{%s}}' % key, str(value))
+    return texto
+
+def _fusionar_runs(paragraph, reemplazos):
+    """
+    Une el texto de los runs del párrafo en un solo run (Arial 11) con los
+    marcadores reemplazados, conservando el formato del primer run
+
+    Returns:
+        Run: El nuevo run
+    """
+    # Concatenar todo el texto de los runs en el párrafo
+    full_text = ''
+    formatting = []
+    for run in paragraph.runs:
+        full_text += run.text
+        formatting.append({
+            'bold': run.bold,
+            'italic': run.italic,
+            'underline': run.underline,
+            # No guardamos font_name ni font_size
+            'font_color': run.font.color.rgb
+        })
+
+    # Reemplazar los marcadores de posición en el texto completo
+    new_full_text = reemplazar_texto(full_text, reemplazos)
+
+    # Borrar los runs existentes
+    for run in paragraph.runs:
+        run.text = ''
+
+    # Crear un nuevo run con el texto reemplazado
+    run = paragraph.add_run(new_full_text)
+    # Aplicar el formato del primer run original
+    if formatting:
+        fmt = formatting[0]
+        run.bold = fmt['bold']
+        run.italic = fmt['italic']
+        run.underline = fmt['underline']
+        run.font.color.rgb = fmt['font_color']
+    else:
+        # Valores por defecto si no hay formato original
+        run.bold = False
+        run.italic = False
+        run.underline = False
+
+    # Establecer la fuente a Arial 11
+    run.font.name = 'Arial'
+    run.font.size = Pt(11)
+    return run
+
+@medido('render')
+def generar_cotizacion(pdf_file, data, tdr=None, motor=None):
+    """
+    Genera el documento de cotización a partir de la plantilla
+
+    Args:
+        pdf_file: TDR (solo se lee si no se pasa `tdr`)
+        data: Datos del proveedor y de la oferta, con la firma en data['firma']
+        tdr: TdrDocument ya analizado
+        motor: 'docx' (python-docx) o 'xml' (segmentos de XML precompilados);
+            por defecto MOTOR_COTIZACION
+
+    Returns:
+        BytesIO: Documento DOCX generado
+    """
+    motor = motor or MOTOR_COTIZACION
+    if motor not in ('docx', 'xml'):
+        raise ValueError(f"Motor de cotización desconocido: {motor}")
+
+    # Extraer datos del PDF (una sola lectura, salvo que ya venga analizado)
+    if tdr is None:
+        tdr = parse_tdr(pdf_file)
 
     # Actualizar data con los datos extraídos
-    data['servicio'] = servicio
-    data['armada'] = forma_pago
-    data['dias'] = dias
+    data['servicio'] = tdr.servicio
+    data['armada'] = tdr.forma_pago
+    data['dias'] = tdr.dias
 
-    # Cargar el documento
     template_path = os.path.join(base_dir, 'FormatoCotizacion.docx')
-    doc = Document(template_path)
-
-    # Diccionario de reemplazos
-    reemplazos = {
-        '{{fecha}}': data['fecha'],
-        '{{servicio}}': data['servicio'],
-        '{{dias}}': data['dias'],
-        '{{oferta}}': "{:.2f}".format(data['oferta']),
-        '{{armada}}': data['armada'],
-        '{{MES}}': data['mes'],
-        '{{dni}}': data['dni'],
-        '{{nombres}}': data['nombres'],
-        '{{ruc}}': data['ruc'],
-        '{{telefono}}': data['telefono'],
-        '{{correo}}': data['correo'],
-        '{{direccion}}': data['direccion'],
-        '{{banco}}': data['banco'],
-        '{{cuenta}}': data['cuenta'],
-        '{{cci}}': data['cci'],
-        '{{year}}': str(data['year']),
-    }
+    plantilla = obtener_plantilla(template_path)
+    reemplazos = _reemplazos_cotizacion(data)
+
+    if motor == 'xml':
+        data['firma'].seek(0)
+        return plantilla.compilar_xml().renderizar(reemplazos, data['firma'].read())
 
-    def reemplazar_texto(texto, reemplazos):
-        for key, value in reemplazos.items():
-            texto = texto.replace(key, str(value))
-        return texto
+    # Copiar la plantilla ya cargada
+    doc, parrafos_con_marcadores = plantilla.nuevo_documento()
 
-    def procesar_parrafo(paragraph):
-        if '{{firma}}' in paragraph.text:
+    # Procesar solo los párrafos que tienen marcadores
+    for paragraph, marcadores in parrafos_con_marcadores:
+        if 'firma' in marcadores:
             # Manejar la firma como antes
             p = paragraph._element
             p.clear_content()
             run = paragraph.add_run()
             data['firma'].seek(0)
-            run.add_picture(BytesIO(data['firma'].read()), height=Cm(1.91))
+            run.add_picture(BytesIO(data['firma'].read()), height=Cm(FIRMA_ALTO_CM))
         else:
-            # Concatenar todo el texto de los runs en el párrafo
-            full_text = ''
-            formatting = []
-            for run in paragraph.runs:
-                full_text += run.text
-                formatting.append({
-                    'bold': run.bold,
-                    'italic': run.italic,
-                    'underline': run.underline,
-                    # No guardamos font_name ni font_size
-                    'font_color': run.font.color.rgb
-                })
-
-            # Reemplazar los marcadores de posición en el texto completo
-            new_full_text = reemplazar_texto(full_text, reemplazos)
-
-            # Borrar los runs existentes
-            for run in paragraph.runs:
-                run.text = ''
-
-            # Crear un nuevo run con el texto reemplazado
-            run = paragraph.add_run(new_full_text)
-            # Aplicar el formato del primer run original
-            if formatting:
-                fmt = formatting[0]
-                run.bold = fmt['bold']
-                run.italic = fmt['italic']
-                run.underline = fmt['underline']
-                run.font.color.rgb = fmt['font_color']
-            else:
-                # Valores por defecto si no hay formato original
-                run.bold = False
-                run.italic = False
-                run.underline = False
-
-            # Establecer la fuente a Arial 11
-            run.font.name = 'Arial'
-            run.font.size = Pt(11)
-
-    # Procesar todos los párrafos en el documento principal
-    for paragraph in doc.paragraphs:
-        procesar_parrafo(paragraph)
-
-    # Función recursiva para procesar tablas anidadas
-    def procesar_tabla(tabla):
-        for row in tabla.rows:
-            for cell in row.cells:
-                # Procesar párrafos dentro de la celda
-                for paragraph in cell.paragraphs:
-                    procesar_parrafo(paragraph)
-
-                # Procesar tablas anidadas dentro de la celda
-                for tabla_anidada in cell.tables:
-                    procesar_tabla(tabla_anidada)
-
-    # Procesar todas las tablas en el documento
-    for tabla in doc.tables:
-        procesar_tabla(tabla)
+            _fusionar_runs(paragraph, reemplazos)
 
     # Guardar el documento modificado en un BytesIO
     doc_io = BytesIO()
@@ -348,12 +1091,170 @@ def generar_cci(banco, cuenta):
     }
     return cci_map.get(banco, "")
 
+def formatear_fecha(fecha):
+    """
+    Devuelve la fecha en español ("5 de marzo de 2025") y el mes en mayúsculas
+    """
+    meses = {
+        "January": "enero", "February": "febrero", "March": "marzo", "April": "abril",
+        "May": "mayo", "June": "junio", "July": "julio", "August": "agosto",
+        "September": "setiembre", "October": "octubre", "November": "noviembre", "December": "diciembre"
+    }
+    mes = meses[fecha.strftime("%B")]
+    return f"{fecha.day} de {mes} de {fecha.year}", mes.upper()
+
+@medido('zip')
+def empaquetar_cotizacion(doc_io, firma_io, tdr_contenido, constancias=None, destino=None):
+    """
+    Arma el ZIP de la cotización copiando cada archivo por bloques
+
+    Los PDF y PNG que ya vienen comprimidos se guardan tal cual (STORED) y el
+    resto se comprime; ver empaque.elegir_compresion. Las constancias se
+    combinan directo en su entrada del ZIP, en el orden RNP, RUC, RNSSC.
+
+    Args:
+        doc_io: Documento de cotización generado
+        firma_io: Imagen de la firma procesada
+        tdr_contenido: TDR original (bytes, BytesIO o ruta)
+        constancias: Constancias descargadas (dict fuente -> ruta, lista de rutas o
+            la ruta de un PDF ya combinado)
+        destino: Ruta o archivo donde escribir el ZIP (por defecto, en memoria)
+
+    Returns:
+        El destino del ZIP (BytesIO al inicio si se armó en memoria)
+    """
+    escribir_constancias = preparar_combinacion(constancias) if constancias else None
+
+    zip_io = BytesIO() if destino is None else destino
+    escribir_zip(zip_io, [
+        ('Formato de Cotización.docx', doc_io),
+        ('Firma.png', firma_io),
+        ('6. Copia de Terminos de Referencia.pdf', tdr_contenido),
+        ('5. RNP, RUC, RNSSC.pdf', escribir_constancias),
+    ])
+
+    if hasattr(zip_io, 'seek'):
+        zip_io.seek(0)
+    return zip_io
+
+ETAPAS_COTIZACION = ('Datos de SUNAT', 'Documento de cotización', 'Constancias', 'Archivo ZIP')
+
+def ejecutar_cotizacion(trabajo, entrada):
+    """
+    Genera la cotización completa en segundo plano (lo ejecuta la cola de trabajos)
+
+    Args:
+        trabajo: Trabajo en el que se informa el avance de cada etapa
+        entrada: Datos del formulario, con el TDR ya analizado y copias del PDF y la firma
+
+    Returns:
+        BytesIO: ZIP con todos los archivos de la cotización
+    """
+    # El id de correlación es el de la sesión que preparó la cotización, así sus
+    # tramos (TDR, SUNAT, geocodificación, rembg) y los del trabajo van juntos
+    with traza(entrada.get('correlacion') or trabajo.id):
+        dni = entrada['dni']
+        with trabajo.etapa('Datos de SUNAT'):
+            try:
+                nombres, ruc = cliente_sunat().consultar(dni, entrada['apisnet_key'])
+            except Exception as e:
+                raise RuntimeError(f"Error al conectar con la API de SUNAT: {e}")
+            if not nombres:
+                raise RuntimeError("No se pudo obtener datos de SUNAT. Verifica el DNI ingresado.")
+
+        with trabajo.etapa('Documento de cotización'):
+            # Formatear la fecha actual en español
+            fecha_actual = datetime.now()
+            fecha_formateada, mes_actual = formatear_fecha(fecha_actual)
+
+            # Preparar datos para generar la cotización
+            data = {
+                'dni': dni,
+                'nombres': nombres,
+                'ruc': ruc,
+                'telefono': entrada['telefono'],
+                'correo': entrada['correo'],
+                'direccion': entrada['direccion'],
+                'banco': entrada['banco'],
+                'cuenta': entrada['cuenta'],
+                'cci': entrada['cci'],
+                'oferta': entrada['oferta'],
+                'fecha': fecha_formateada,
+                'year': fecha_actual.year,
+                'mes': mes_actual,
+                'firma': BytesIO(entrada['firma']),
+            }
+            doc_io = generar_cotizacion(None, data, tdr=entrada['tdr'])
+
+        # Carpeta exclusiva de este trabajo (la limpieza la borra luego)
+        with gestor_espacios().crear() as espacio:
+            with trabajo.etapa('Constancias'), tramo('constancias'):
+                constancias = descargar_constancias(ruc, dni, espacio.ruta, espacio=espacio)
+
+            with trabajo.etapa('Archivo ZIP'):
+                return empaquetar_cotizacion(doc_io, entrada['firma'], entrada['pdf'], constancias)
+
+ICONOS_ETAPA = {HECHA: '✅', EN_CURSO: '⏳', FALLIDO: '❌'}
+
+def _panel_trabajo():
+    trabajo_id = st.session_state.get('trabajo_id')
+    trabajo = cola_trabajos().obtener(trabajo_id)
+    if trabajo is None:
+        st.session_state.pop('trabajo_id', None)
+        st.warning("La cotización anterior ya no está disponible. Vuelve a generarla.")
+        return
+
+    if trabajo.finalizado and st.session_state.get('trabajo_sondeo') == trabajo_id:
+        # Terminó mientras se sondeaba: un rerun completo deja de sondear
+        st.session_state.pop('trabajo_sondeo', None)
+        st.rerun()
+
+    etapa = trabajo.etapa_actual()
+    texto = f"Generando cotización: {etapa}..." if etapa else "Cotización en cola..."
+    if not trabajo.finalizado:
+        st.progress(trabajo.progreso(), text=texto)
+    st.markdown("  \n".join(
+        f"{ICONOS_ETAPA.get(estado, '▫️')} {nombre}" for nombre, estado in trabajo.etapas.items()
+    ))
+
+    if trabajo.estado == TERMINADO:
+        st.success("¡Cotización generada correctamente!")
+        # Botón para descargar el ZIP
+        st.download_button(
+            label="Descargar Todos los Archivos Generados (ZIP)",
+            data=trabajo.resultado,
+            file_name="cotizacion.zip",
+            mime="application/zip",
+        )
+    elif trabajo.estado == FALLIDO:
+        st.error(trabajo.error)
+    elif trabajo.estado == CANCELADO:
+        st.info("Cotización cancelada.")
+    elif st.button("Cancelar", key=f"cancelar_{trabajo_id}"):
+        cola_trabajos().cancelar(trabajo_id)
+
+def mostrar_trabajo():
+    """
+    Muestra el avance del trabajo de la sesión; mientras corre, solo este panel
+    se actualiza cada TRABAJO_SONDEO_S segundos
+    """
+    trabajo_id = st.session_state.get('trabajo_id')
+    if not trabajo_id:
+        return
+    trabajo = cola_trabajos().obtener(trabajo_id)
+    activo = trabajo is not None and not trabajo.finalizado
+    if activo:
+        st.session_state['trabajo_sondeo'] = trabajo_id
+    st.fragment(_panel_trabajo, run_every=TRABAJO_SONDEO_S if activo else None)()
+
 def main():
     st.set_page_config(
         page_title="Genera tu Cotización",
         page_icon="🎣",
         layout="wide"
     )
+    if REMBG_PRECARGAR:
+        servicio_remover_fondo().precargar()
     # Inicializar variables de estado para la ubicación
     if 'zoom' not in st.session_state:
         st.session_state['zoom'] = 13
@@ -363,6 +1264,8 @@ def main():
         st.session_state['lon'] = None
     if 'direccion' not in st.session_state:
         st.session_state['direccion'] = ''
+    if 'zoom_mapa' not in st.session_state:
+        st.session_state['zoom_mapa'] = st.session_state['zoom']
 
     # Sección de carga de TDR
     st.header("Sube tu TDR (PDF)")
@@ -425,17 +1328,13 @@ def main():
             st.write("Obteniendo ubicación...")
 
     # Recuperar la ubicación desde st.session_state después de la llamada
-    if 'geo_loc' in st.session_state:
-        loc = st.session_state['geo_loc']
-        if loc and 'coords' in loc:
-            st.session_state.lat = loc['coords']['latitude']
-            st.session_state.lon = loc['coords']['longitude']
-            direccion = obtener_direccion_desde_coordenadas(
-                st.session_state.lat,
-                st.session_state.lon
-            )
-            if direccion:
-                st.session_state.direccion = direccion
+    loc = st.session_state.get('geo_loc')
+    if loc and 'coords' in loc:
+        coords = (loc['coords']['latitude'], loc['coords']['longitude'])
+        # Procesar cada ubicación una sola vez y no en cada rerun
+        if coords != st.session_state.get('ultima_geo'):
+            st.session_state['ultima_geo'] = coords
+            actualizar_ubicacion(*coords)
 
     # Un solo campo de dirección fuera de las columnas
     direccion_input = st.text_input(
@@ -447,38 +1346,18 @@ def main():
     st.session_state.direccion = direccion_input
 
     with col2:
-        # Mostrar el mapa con la ubicación si está disponible y el zoom actual
-        mapa = crear_mapa(
-            lat=st.session_state['lat'],
-            lon=st.session_state['lon'],
-            zoom=st.session_state['zoom']
-        )
+        # Mostrar el mapa; es el mismo objeto mientras no cambie la ubicación
         mapa_data = st_folium(
-            mapa,
+            mapa_de_sesion(),
+            key='mapa',
             height=300,
             width=None,
             returned_objects=["last_clicked", "zoom"]
         )
-
-        # Actualizar ubicación cuando se hace clic en el mapa
-        if mapa_data["last_clicked"]:
-            clicked_lat = mapa_data["last_clicked"]["lat"]
-            clicked_lng = mapa_data["last_clicked"]["lng"]
-
-            # Guardar el zoom actual antes de actualizar
-            if mapa_data.get("zoom"):
-                st.session_state['zoom'] = mapa_data["zoom"]
-
-            # Actualizar estado
-            st.session_state['lat'] = clicked_lat
-            st.session_state['lon'] = clicked_lng
-            nueva_direccion = obtener_direccion_desde_coordenadas(clicked_lat, clicked_lng)
-            if nueva_direccion:
-                st.session_state['direccion'] = nueva_direccion
-                st.rerun()
-        # Actualizar el zoom incluso si no se hace clic
-        elif mapa_data.get("zoom"):
-            st.session_state['zoom'] = mapa_data["zoom"]
+    # Un clic nuevo mueve el marcador y llena la dirección: se vuelve a dibujar
+    # la página una vez con la ubicación nueva
+    if procesar_clic_mapa(mapa_data):
+        st.rerun()
 
     # Información bancaria
     st.header("Información Bancaria")
@@ -504,8 +1383,10 @@ def main():
     
     # Extraer días del PDF si está disponible
     dias = "30"  # Valor por defecto
+    tdr = None
     if pdf_file:
-        dias = extraer_dias(pdf_file)
+        tdr = parse_tdr(pdf_file)
+        dias = tdr.dias
     
     # Obtener el valor sugerido basado en los días
     valor_sugerido = obtener_valor_sugerido(dias)
@@ -545,77 +1426,46 @@ def main():
         if not all([pdf_file, firma_cargada, dni, st.session_state.direccion, telefono, correo, banco_seleccionado, cuenta, cci, oferta_total]):
             st.error("Por favor, complete todos los campos requeridos.")
         else:
-            # Obtener datos de SUNAT
-            nombres, ruc = obtener_datos_sunat(dni)
-            if not nombres:
-                st.error("No se pudo obtener datos de SUNAT. Verifica el DNI ingresado.")
-            else:
-                # Formatear la fecha actual en español
-                meses = {
-                    "January": "enero", "February": "febrero", "March": "marzo", "April": "abril",
-                    "May": "mayo", "June": "junio", "July": "julio", "August": "agosto",
-                    "September": "setiembre", "October": "octubre", "November": "noviembre", "December": "diciembre"
-                }
-                fecha_actual = datetime.now()
-                mes_actual = meses[fecha_actual.strftime("%B")].upper()
-                fecha_formateada = f"{fecha_actual.day} de {meses[fecha_actual.strftime('%B')]} de {fecha_actual.year}"
-                output_directory = os.path.join(base_dir, 'temp_downloads')
-                os.makedirs(output_directory, exist_ok=True)
-
-                # Preparar datos para generar la cotización
-                data = {
-                    'dni': dni,
-                    'nombres': nombres,
-                    'ruc': ruc,
-                    'telefono': telefono,
-                    'correo': correo,
-                    'direccion': st.session_state.direccion,
-                    'banco': banco_seleccionado,
-                    'cuenta': cuenta,
-                    'cci': cci,
-                    'oferta': oferta_total,
-                    'fecha': fecha_formateada,
-                    'year': fecha_actual.year,
-                    'mes': mes_actual,
-                    'firma': firma_procesada,
-                }
-
-                # Generar la cotización
-                doc_io = generar_cotizacion(pdf_file, data)
-
-                # Combinar PDFs de constancias
-                combinar_pdfs(output_directory, '5. RNP, RUC, RNSSC.pdf')
-
-                # Crear un archivo ZIP en memoria
-                zip_io = BytesIO()
-                with zipfile.ZipFile(zip_io, mode='w', compression=zipfile.ZIP_DEFLATED) as zipf:
-                    # Agregar el documento de cotización
-                    zipf.writestr('Formato de Cotización.docx', doc_io.getvalue())
-                    
-                    # Agregar la firma
-                    firma_procesada.seek(0)  # Reiniciar el puntero del archivo
-                    zipf.writestr('Firma.png', firma_procesada.getvalue())
-                    
-                    # Agregar el TDR original
-                    pdf_file.seek(0)  # Reiniciar el puntero del archivo
-                    zipf.writestr('6. Copia de Terminos de Referencia.pdf', pdf_file.getvalue())
-                    
-                    # Agregar el PDF combinado de constancias
-                    constancias_path = os.path.join(output_directory, '5. RNP, RUC, RNSSC.pdf')
-                    if os.path.exists(constancias_path):
-                        with open(constancias_path, 'rb') as constancias_file:
-                            zipf.writestr('5. RNP, RUC, RNSSC.pdf', constancias_file.read())
-
-                zip_io.seek(0)
-                st.success("¡Cotización generada correctamente!")
-
-                # Botón para descargar el ZIP
-                st.download_button(
-                    label="Descargar Todos los Archivos Generados (ZIP)",
-                    data=zip_io.getvalue(),
-                    file_name="cotizacion.zip",
-                    mime="application/zip",
-                )
+            # Copias propias de los archivos: la sesión puede cambiarlos mientras
+            # el trabajo corre en segundo plano
+            entrada = {
+                'apisnet_key': st.secrets["APISNET"]["key"],
+                'tdr': tdr,
+                'pdf': pdf_file.getvalue(),
+                'firma': firma_procesada.getvalue(),
+                'dni': dni,
+                'telefono': telefono,
+                'correo': correo,
+                'direccion': st.session_state.direccion,
+                'banco': banco_seleccionado,
+                'cuenta': cuenta,
+                'cci': cci,
+                'oferta': oferta_total,
+                'correlacion': correlacion_sesion(),
+            }
+            # Un trabajo nuevo reemplaza al anterior de la sesión
+            anterior = st.session_state.get('trabajo_id')
+            if anterior:
+                cola_trabajos().cancelar(anterior)
+            st.session_state['trabajo_id'] = cola_trabajos().enviar(
+                ejecutar_cotizacion, ETAPAS_COTIZACION, entrada
+            )
+            # La próxima cotización de la sesión tendrá su propio id
+            st.session_state.pop('correlacion', None)
+
+    # Avance y resultado del trabajo de la sesión (sobrevive a los reruns)
+    mostrar_trabajo()
     
+def correlacion_sesion():
+    """
+    Id de correlación de la cotización que la sesión está preparando
+    """
+    if 'correlacion' not in st.session_state:
+        st.session_state['correlacion'] = uuid.uuid4().hex
+    return st.session_state['correlacion']
+
 if __name__ == "__main__":
-    main()
+    # Lo que la página mide (TDR, SUNAT, geocodificación, rembg) queda con el id
+    # de la cotización en preparación, el mismo que usará su trabajo
+    with traza(correlacion_sesion(), nombre=None):
+        main()
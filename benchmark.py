@@ -0,0 +1,314 @@
+# benchmark.py
+"""
+Micro-benchmarks de las etapas de una cotización.
+
+Uso:
+    python benchmark.py [--solo PATRON] [--repeticiones N] [--latencia S]
+                        [--guardar base.json] [--comparar base.json] [--umbral 0.2]
+
+Los datos de prueba se generan al vuelo (TDR sintéticos de 5, 50 y 200 páginas,
+una firma dibujada, PDF de constancias) y los servicios externos (SUNAT,
+Nominatim y los portales de constancias) se reemplazan por portales_simulados.py,
+así los tiempos no dependen de la red.
+
+Con --guardar se escribe un JSON de referencia; con --comparar se mide de nuevo
+y se marcan como regresión las etapas cuya mediana supera la de referencia en
+más de --umbral (0.2 = 20 %). El proceso retorna 1 si hay regresiones.
+"""
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from io import BytesIO
+
+from geopy.geocoders import Nominatim
+from PIL import Image, ImageDraw
+
+import app
+import constancia
+import pdf_simple
+import portales_simulados
+
+PAGINAS_TDR = (5, 50, 200)
+REPETICIONES = 5
+# Las etapas lentas se miden menos veces y sin calentamiento
+MAX_REPETICIONES = {'tdr_extraer_50p': 3, 'tdr_extraer_200p': 2, 'arranque_app': 5}
+UMBRAL_REGRESION = 0.2
+# Carpeta de app.py: el arranque se mide desde ahí, se ejecute desde donde se ejecute
+CARPETA_APP = os.path.dirname(os.path.abspath(__file__))
+
+def tdr_sintetico(paginas):
+    """
+    PDF de TDR con los campos que busca parse_tdr repartidos en el documento.
+
+    El objeto va al inicio, el plazo a la mitad y la forma de pago en la última
+    página: el peor caso para la lectura con salida temprana.
+    """
+    relleno = [
+        f"{n}. Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor."
+        for n in range(1, 50)
+    ]
+    contenido = [list(relleno) for _ in range(paginas)]
+    contenido[0] = [
+        "TERMINOS DE REFERENCIA",
+        "1. AREA USUARIA",
+        "Dirección General de Pesca Artesanal",
+        "2. OBJETO DE LA CONTRATACION",
+        "Contratación del servicio de un especialista para la elaboración",
+        "de informes técnicos del sector pesquero",
+        "3. FINALIDAD PUBLICA",
+    ] + relleno[:40]
+    contenido[paginas // 2] = relleno[:20] + [
+        "El plazo de ejecución del servicio es de hasta 45 días calendario, contados desde",
+        "el día siguiente de notificada la orden de servicio.",
+    ] + relleno[20:]
+    contenido[-1] = relleno[:30] + [
+        "El pago se realizará en dos (02) armadas, previo informe del área usuaria,",
+        "luego de la emisión de la conformidad del servicio, y otros requisitos.",
+    ]
+    return pdf_simple.escribir_pdf(contenido, titulo=f"TDR sintético de {paginas} páginas")
+
+def firma_sintetica(ancho=2400, alto=900):
+    """
+    Foto simulada de una firma: trazo oscuro sobre papel con algo de ruido
+    """
+    imagen = Image.effect_noise((ancho, alto), 12).convert('RGB')
+    imagen = Image.blend(Image.new('RGB', (ancho, alto), (235, 232, 225)), imagen, 0.15)
+    dibujo = ImageDraw.Draw(imagen)
+    puntos = [(x, alto // 2 + int(alto / 4 * ((x * 7919) % 97 - 48) / 48)) for x in range(100, ancho - 100, 60)]
+    dibujo.line(puntos, fill=(20, 20, 60), width=14, joint='curve')
+    salida = BytesIO()
+    imagen.save(salida, format='JPEG', quality=90)
+    return salida.getvalue()
+
+def _modelo_rembg_disponible():
+    carpeta = os.path.expanduser(os.environ.get('U2NET_HOME', os.path.join('~', '.u2net')))
+    return os.path.exists(os.path.join(carpeta, f"{app.REMBG_MODELO}.onnx"))
+
+def medir(funcion, repeticiones, preparar=None, calentamiento=1):
+    """
+    Ejecuta `funcion` `calentamiento` veces sin medir y luego `repeticiones` veces midiendo
+
+    Returns:
+        dict: Estadísticas en segundos
+    """
+    tiempos = []
+    for i in range(calentamiento + repeticiones):
+        argumento = preparar() if preparar else None
+        inicio = time.perf_counter()
+        funcion(argumento) if preparar else funcion()
+        transcurrido = time.perf_counter() - inicio
+        if i >= calentamiento:
+            tiempos.append(transcurrido)
+
+    tiempos.sort()
+    return {
+        'mediana_s': statistics.median(tiempos),
+        'p95_s': tiempos[min(len(tiempos) - 1, round(0.95 * (len(tiempos) - 1)))],
+        'min_s': tiempos[0],
+        'repeticiones': len(tiempos),
+    }
+
+def definir_benchmarks(carpeta, url_simulada):
+    """
+    Prepara los datos de prueba y retorna [(nombre, funcion, preparar o None)]
+    """
+    benchmarks = []
+
+    # Arranque en frío: importar la app en un proceso nuevo (detalle por módulo
+    # con `python carga_diferida.py`)
+    benchmarks.append((
+        "arranque_app",
+        lambda: subprocess.run(
+            [sys.executable, '-c', 'import app'], check=True, capture_output=True, cwd=CARPETA_APP,
+        ),
+        None,
+    ))
+
+    data_base = {
+        'dni': '12345678', 'nombres': 'JUAN PEREZ', 'ruc': '10123456789',
+        'telefono': '999888777', 'correo': 'proveedor@correo.pe', 'direccion': 'Jr. de la Unión 123, Lima',
+        'banco': 'BCP', 'cuenta': '191-12345678-0-12', 'cci': '00219100123456780122',
+        'oferta': 4500.0, 'fecha': '17 de octubre de 2026', 'year': 2026, 'mes': 'OCTUBRE',
+    }
+
+    # Extracción de TDR en frío (sin caché) por tamaño
+    tdrs = {}
+    for paginas in PAGINAS_TDR:
+        tdrs[paginas] = contenido = tdr_sintetico(paginas)
+
+        def extraer(contenido=contenido):
+            app._cache_tdr().clear()
+            archivo = BytesIO(contenido)
+            app.extraer_nombre_servicio(archivo)
+            app.extraer_forma_pago(archivo)
+            app.extraer_dias(archivo)
+
+        benchmarks.append((f"tdr_extraer_{paginas}p", extraer, None))
+
+    # Firma, con y sin remover el fondo
+    foto_firma = firma_sintetica()
+
+    def firma(remover_fondo):
+        app._cache_firmas().clear()
+        return app.procesar_firma(BytesIO(foto_firma), remover_fondo)
+
+    benchmarks.append(("procesar_firma", lambda: firma(False), None))
+    if _modelo_rembg_disponible():
+        benchmarks.append(("procesar_firma_sin_fondo", lambda: firma(True), None))
+    else:
+        print(f"Omitido procesar_firma_sin_fondo: no está el modelo {app.REMBG_MODELO} de rembg", file=sys.stderr)
+    firma_png = firma(False).getvalue()
+
+    # Generación del DOCX con cada motor
+    tdr = app.parse_tdr(BytesIO(tdrs[5]))
+    for motor in ('docx', 'xml'):
+        def generar(data, motor=motor):
+            return app.generar_cotizacion(None, data, tdr=tdr, motor=motor)
+
+        benchmarks.append((
+            f"generar_cotizacion_{motor}", generar,
+            lambda: {**data_base, 'firma': BytesIO(firma_png)},
+        ))
+    doc_io = app.generar_cotizacion(None, {**data_base, 'firma': BytesIO(firma_png)}, tdr=tdr)
+
+    # Combinación de constancias
+    constancias = []
+    for nombre, paginas in (('RNP_1.pdf', 2), ('SUNAT_1.pdf', 1), ('RNSSC_1.pdf', 1)):
+        ruta = os.path.join(carpeta, nombre)
+        with open(ruta, 'wb') as f:
+            f.write(pdf_simple.escribir_pdf([[nombre] * 40] * paginas))
+        constancias.append(ruta)
+
+    benchmarks.append((
+        "combinar_pdfs",
+        lambda: constancia.combinar_pdfs(carpeta, 'combinado.pdf', archivos=constancias),
+        None,
+    ))
+
+    # Empaquetado ZIP con el TDR más grande (incluye combinar las constancias)
+    benchmarks.append((
+        "empaquetar_zip",
+        lambda: app.empaquetar_cotizacion(doc_io, firma_png, tdrs[200], constancias),
+        None,
+    ))
+
+    # Servicios externos contra los simulados (siempre en frío)
+    cliente = app.ClienteSunat()
+    cliente.URL = f"{url_simulada}/v2/sunat/dni"
+
+    def sunat():
+        cliente.cache.clear()
+        cliente.consultar('12345678', 'token')
+
+    benchmarks.append(("sunat_dni", sunat, None))
+
+    geocodificador = app.GeocodificadorInverso(tasa=1000)
+    geocodificador.geolocator = Nominatim(
+        user_agent="benchmark", domain=url_simulada.split('://')[1], scheme='http'
+    )
+
+    def geocodificar():
+        geocodificador.cache.clear()
+        geocodificador.direccion(-12.0464, -77.0428)
+
+    benchmarks.append(("geocodificar", geocodificar, None))
+
+    constancia.RNP_BASE_URL = constancia.SUNAT_RUC_BASE_URL = constancia.RNSSC_BASE_URL = url_simulada
+    benchmarks.append((
+        "constancias_http",
+        lambda: constancia.descargar_fuentes(
+            '10123456789', '12345678', os.path.join(carpeta, 'descargas'), usar_almacen=False
+        ),
+        None,
+    ))
+
+    return benchmarks
+
+def ejecutar(solo=None, repeticiones=REPETICIONES, latencia=0.0):
+    """
+    Ejecuta los benchmarks (filtrados por el patrón `solo`) y retorna el informe
+    """
+    servidor, url = portales_simulados.iniciar_servidor(latencia=latencia)
+    resultados = {}
+    try:
+        with tempfile.TemporaryDirectory() as carpeta:
+            for nombre, funcion, preparar in definir_benchmarks(carpeta, url):
+                if solo and not fnmatch.fnmatch(nombre, solo):
+                    continue
+                if nombre in MAX_REPETICIONES:
+                    medida = medir(funcion, min(repeticiones, MAX_REPETICIONES[nombre]), preparar, calentamiento=0)
+                else:
+                    medida = medir(funcion, repeticiones, preparar)
+                resultados[nombre] = medida
+                print(f"  {nombre:<28} mediana {resultados[nombre]['mediana_s'] * 1000:9.2f} ms"
+                      f"   p95 {resultados[nombre]['p95_s'] * 1000:9.2f} ms", file=sys.stderr)
+    finally:
+        servidor.shutdown()
+
+    return {
+        'meta': {
+            'fecha': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'plataforma': platform.platform(),
+            'repeticiones': repeticiones,
+            'latencia_simulada_s': latencia,
+        },
+        'resultados': resultados,
+    }
+
+def comparar(base, actual, umbral=UMBRAL_REGRESION):
+    """
+    Compara las medianas de dos informes
+
+    Returns:
+        list: (nombre, mediana base, mediana actual, cambio relativo, es_regresion)
+    """
+    filas = []
+    for nombre, medida in actual['resultados'].items():
+        referencia = base['resultados'].get(nombre)
+        if not referencia:
+            continue
+        cambio = medida['mediana_s'] / referencia['mediana_s'] - 1
+        filas.append((nombre, referencia['mediana_s'], medida['mediana_s'], cambio, cambio > umbral))
+    return filas
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de las etapas de la cotización")
+    parser.add_argument('--solo', help="Patrón de nombres a ejecutar (por ejemplo 'tdr_*')")
+    parser.add_argument('--repeticiones', type=int, default=REPETICIONES)
+    parser.add_argument('--latencia', type=float, default=0.0, help="Demora de los servicios simulados en segundos")
+    parser.add_argument('--guardar', help="Escribe los resultados como referencia JSON")
+    parser.add_argument('--comparar', help="Compara con una referencia JSON")
+    parser.add_argument('--umbral', type=float, default=UMBRAL_REGRESION, help="Regresión tolerada (0.2 = 20 %%)")
+    args = parser.parse_args(argv)
+
+    informe = ejecutar(args.solo, args.repeticiones, args.latencia)
+
+    if args.guardar:
+        with open(args.guardar, 'w', encoding='utf-8') as f:
+            json.dump(informe, f, indent=2, ensure_ascii=False)
+        print(f"Referencia guardada en {args.guardar}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            base = json.load(f)
+        filas = comparar(base, informe, args.umbral)
+        print(f"\n{'etapa':<28} {'base ms':>10} {'actual ms':>10} {'cambio':>8}")
+        for nombre, antes, ahora, cambio, regresion in filas:
+            marca = "  REGRESIÓN" if regresion else ""
+            print(f"{nombre:<28} {antes * 1000:10.2f} {ahora * 1000:10.2f} {cambio:+8.1%}{marca}")
+        if any(fila[4] for fila in filas):
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+# cache.py
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# Recursos compartidos por todo el proceso. Viven en un módulo importado (y no en
+# app.py) porque Streamlit vuelve a ejecutar el script principal en cada rerun.
+_recursos = {}
+_recursos_lock = threading.Lock()
+
+def compartido(nombre, fabrica):
+    """
+    Devuelve un recurso único por proceso, creándolo con `fabrica` la primera vez
+    """
+    with _recursos_lock:
+        if nombre not in _recursos:
+            _recursos[nombre] = fabrica()
+        return _recursos[nombre]
+
+class CacheLRU:
+    """
+    Caché LRU en memoria, seguro entre hilos, con expiración por TTL.
+
+    Con `max_bytes` también se limita la suma de los tamaños de los valores
+    (medidos con `peso`, por defecto len()), desalojando los menos usados.
+    """
+    def __init__(self, max_entries=128, ttl=None, max_bytes=None, peso=len):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.peso = peso
+        self._bytes = 0
+        self._datos = OrderedDict()
+        self._en_curso = {}
+        self._lock = threading.Lock()
+
+    def get(self, clave, default=None):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                return default
+            valor, expira, _ = entrada
+            if expira is not None and expira < time.monotonic():
+                self._quitar(clave)
+                return default
+            self._datos.move_to_end(clave)
+            return valor
+
+    def set(self, clave, valor, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expira = time.monotonic() + ttl if ttl is not None else None
+        peso = self.peso(valor) if self.max_bytes is not None else 0
+        with self._lock:
+            if clave in self._datos:
+                self._quitar(clave)
+            if self.max_bytes is not None and peso > self.max_bytes:
+                # Un valor más grande que todo el caché no se guarda
+                return
+            self._datos[clave] = (valor, expira, peso)
+            self._bytes += peso
+            while len(self._datos) > self.max_entries or (
+                self.max_bytes is not None and self._bytes > self.max_bytes
+            ):
+                self._quitar(next(iter(self._datos)))
+
+    def obtener_o_calcular(self, clave, calcular, ttl=None):
+        """
+        Devuelve el valor en caché o lo calcula con `calcular()`.
+
+        Las llamadas simultáneas con la misma clave se agrupan: solo la primera
+        calcula y las demás esperan su resultado (o su excepción, que no se guarda).
+        """
+        valor = self.get(clave, _FALTANTE)
+        if valor is not _FALTANTE:
+            return valor
+
+        with self._lock:
+            futuro = self._en_curso.get(clave)
+            propio = futuro is None
+            if propio:
+                futuro = self._en_curso[clave] = Future()
+        if not propio:
+            return futuro.result()
+
+        try:
+            valor = calcular()
+            self.set(clave, valor, ttl)
+            futuro.set_result(valor)
+            return valor
+        except BaseException as e:
+            futuro.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._en_curso[clave]
+
+    def _quitar(self, clave):
+        _, _, peso = self._datos.pop(clave)
+        self._bytes -= peso
+
+    def __contains__(self, clave):
+        return self.get(clave, _FALTANTE) is not _FALTANTE
+
+    def __len__(self):
+        with self._lock:
+            return len(self._datos)
+
+    def clear(self):
+        with self._lock:
+            self._datos.clear()
+            self._bytes = 0
+
+_FALTANTE = object()
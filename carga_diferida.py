@@ -0,0 +1,164 @@
+# carga_diferida.py
+"""
+Importación diferida de dependencias pesadas e informe de tiempos de importación.
+
+`diferido('rembg', 'remove')` devuelve un objeto que importa `rembg` la primera
+vez que se usa (al llamarlo o al leer uno de sus atributos), así arrancar un
+worker o abrir la página no paga por rembg, folium o selenium hasta que hacen
+falta. Cada carga diferida se mide como un tramo `importar_<modulo>`.
+
+El informe de arranque ejecuta `python -X importtime -c "import <modulo>"` en
+un proceso nuevo y lista lo que cuesta cada importación:
+
+    python carga_diferida.py [--modulo app] [--limite 20] [--todos] [--umbral-ms 1500]
+"""
+import argparse
+import importlib
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from trazas import tramo
+
+# Carpeta de los módulos de la app: desde ahí se miden las importaciones
+CARPETA_APP = os.path.dirname(os.path.abspath(__file__))
+
+_lock = threading.Lock()
+_tiempos = {}
+
+class ModuloDiferido:
+    """
+    Representa un módulo (o uno de sus atributos) que se importa en su primer uso
+    """
+    def __init__(self, modulo, atributo=None):
+        self._modulo = modulo
+        self._atributo = atributo
+        self._objeto = None
+
+    def _cargar(self):
+        if self._objeto is None:
+            with _lock:
+                if self._objeto is None:
+                    inicio = time.perf_counter()
+                    with tramo(f"importar_{self._modulo}"):
+                        objeto = importlib.import_module(self._modulo)
+                    segundos = time.perf_counter() - inicio
+                    _tiempos.setdefault(self._modulo, segundos)
+                    logging.getLogger('carga_diferida').info(
+                        f"{self._modulo} importado en {segundos * 1000:.0f} ms"
+                    )
+                    if self._atributo:
+                        objeto = getattr(objeto, self._atributo)
+                    self._objeto = objeto
+        return self._objeto
+
+    def __getattr__(self, nombre):
+        # Los atributos especiales no disparan la importación (copy, inspect, etc.)
+        if nombre.startswith('__'):
+            raise AttributeError(nombre)
+        return getattr(self._cargar(), nombre)
+
+    def __call__(self, *args, **kwargs):
+        return self._cargar()(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cargar())
+
+    @property
+    def cargado(self):
+        return self._objeto is not None
+
+    def __repr__(self):
+        nombre = f"{self._modulo}.{self._atributo}" if self._atributo else self._modulo
+        return f"<diferido {nombre}{'' if self.cargado else ' (sin cargar)'}>"
+
+def diferido(modulo, atributo=None):
+    """
+    Importa `modulo` (y toma `atributo`, si se indica) en su primer uso
+
+    Args:
+        modulo: Nombre completo del módulo, p. ej. 'selenium.webdriver'
+        atributo: Nombre dentro del módulo, p. ej. 'WebDriverWait'
+
+    Returns:
+        ModuloDiferido: Se usa igual que el módulo o el atributo
+    """
+    return ModuloDiferido(modulo, atributo)
+
+def importaciones_diferidas():
+    """
+    Segundos que tomó cada importación diferida ya realizada en este proceso
+    """
+    with _lock:
+        return dict(_tiempos)
+
+def medir_importaciones(modulo='app', python=None, carpeta=CARPETA_APP):
+    """
+    Importa `modulo` en un proceso nuevo con -X importtime, ejecutado en `carpeta`
+
+    Returns:
+        list: (nombre, propio_s, acumulado_s, profundidad) en orden de importación;
+        la profundidad es 0 para `modulo` y 1 para lo que importa directamente
+    """
+    resultado = subprocess.run(
+        [python or sys.executable, '-X', 'importtime', '-c', f'import {modulo}'],
+        capture_output=True, text=True, cwd=carpeta,
+    )
+    if resultado.returncode != 0:
+        raise RuntimeError(f"No se pudo importar {modulo}: {resultado.stderr.strip().splitlines()[-1:]}")
+
+    filas = []
+    for linea in resultado.stderr.splitlines():
+        if not linea.startswith('import time:') or 'self [us]' in linea:
+            continue
+        propio, acumulado, nombre = linea[len('import time:'):].split('|')
+        profundidad = (len(nombre) - len(nombre.lstrip())) // 2
+        filas.append((nombre.strip(), int(propio) / 1e6, int(acumulado) / 1e6, profundidad))
+
+    # El módulo pedido queda con profundidad 0 y sus importaciones directas con 1
+    base = next((f[3] for f in filas if f[0] == modulo), 0)
+    return [(n, p, a, prof - base) for n, p, a, prof in filas]
+
+def informe_importaciones(modulo='app', limite=20, todos=False):
+    """
+    Texto con el arranque total de `modulo` y sus importaciones más costosas:
+    las directas por tiempo acumulado o, con `todos`, cada módulo por tiempo propio
+    """
+    filas = medir_importaciones(modulo)
+    total = next((a for n, _, a, _ in filas if n == modulo), sum(p for _, p, _, _ in filas))
+
+    if todos:
+        titulo = "tiempo propio"
+        seleccion = sorted(((n, p) for n, p, _, _ in filas), key=lambda f: f[1], reverse=True)
+    else:
+        titulo = "acumulado, importaciones directas"
+        seleccion = sorted(
+            ((n, a) for n, _, a, prof in filas if prof == 1), key=lambda f: f[1], reverse=True
+        )
+
+    lineas = [f"Importar {modulo}: {total * 1000:.0f} ms ({titulo})"]
+    for nombre, segundos in seleccion[:limite]:
+        lineas.append(f"  {nombre:<40} {segundos * 1000:9.1f} ms  {segundos / total:6.1%}")
+    return '\n'.join(lineas), total
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Informe de tiempos de importación")
+    parser.add_argument('--modulo', default='app')
+    parser.add_argument('--limite', type=int, default=20)
+    parser.add_argument('--todos', action='store_true', help="Todos los módulos, por tiempo propio")
+    parser.add_argument('--umbral-ms', type=float, default=None,
+                        help="Termina con código 1 si el arranque supera este tiempo")
+    args = parser.parse_args(argv)
+
+    texto, total = informe_importaciones(args.modulo, args.limite, args.todos)
+    print(texto)
+    if args.umbral_ms is not None and total * 1000 > args.umbral_ms:
+        print(f"El arranque ({total * 1000:.0f} ms) supera el umbral de {args.umbral_ms:g} ms", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
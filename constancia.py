@@ -1,17 +1,80 @@
 # constancia.py
 import logging
 import os
+import queue
+import re
+import secrets
+import shutil
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturoTimeout
+from contextlib import contextmanager
+import lxml.html
 import requests
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
-from PyPDF2 import PdfMerger
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin, urlsplit
+from urllib3.util.retry import Retry
 from datetime import datetime
 
+from almacen import almacen_constancias
+from carga_diferida import diferido
+from cache import compartido
+from trazas import en_contexto, medido, tramo
+
+try:
+    # watchdog (en requirements.txt) usa inotify en Linux; si no está instalado
+    # se revisa la carpeta periódicamente
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+# Selenium y webdriver_manager solo se importan si se usa el navegador
+webdriver = diferido('selenium.webdriver')
+By = diferido('selenium.webdriver.common.by', 'By')
+WebDriverWait = diferido('selenium.webdriver.support.ui', 'WebDriverWait')
+EC = diferido('selenium.webdriver.support.expected_conditions')
+Service = diferido('selenium.webdriver.chrome.service', 'Service')
+ChromeDriverManager = diferido('webdriver_manager.chrome', 'ChromeDriverManager')
+PdfMerger = diferido('PyPDF2', 'PdfMerger')
+
+# Pool de navegadores: cuántos Chrome se mantienen abiertos y cuántas descargas
+# atiende cada uno antes de reemplazarlo
+CHROME_POOL_SIZE = int(os.environ.get('CHROME_POOL_SIZE', '2'))
+CHROME_MAX_USOS = int(os.environ.get('CHROME_MAX_USOS', '20'))
+CHROME_ESPERA_POOL = float(os.environ.get('CHROME_ESPERA_POOL', '60'))
+CHROME_PRECALENTAR = os.environ.get('CHROME_PRECALENTAR', 'false').lower() == 'true'
+
+# Espera de descargas: plazo máximo, tiempo sin cambios de tamaño para dar un
+# archivo por terminado e intervalo de revisión cuando no hay eventos
+DESCARGA_TIMEOUT = float(os.environ.get('DESCARGA_TIMEOUT', '30'))
+DESCARGA_ESTABLE_S = 0.3
+DESCARGA_INTERVALO_S = 0.1
+SUFIJOS_PARCIALES = ('.crdownload', '.tmp', '.part')
+
+# Plazo máximo por fuente de constancias (segundos), en el orden en que se combinan
+TIMEOUTS_CONSTANCIAS = {
+    'RNP': float(os.environ.get('TIMEOUT_RNP', '60')),
+    'RUC': float(os.environ.get('TIMEOUT_RUC', '60')),
+    'RNSSC': float(os.environ.get('TIMEOUT_RNSSC', '30')),
+}
+# Orden de las constancias en el PDF combinado
+ORDEN_CONSTANCIAS = tuple(TIMEOUTS_CONSTANCIAS)
+CONSTANCIAS_HILOS = int(os.environ.get('CONSTANCIAS_HILOS', '6'))
+
+# Portales de constancias (se pueden apuntar a portales_simulados.py para pruebas)
+RNP_BASE_URL = os.environ.get('RNP_BASE_URL', 'https://www.rnp.gob.pe')
+SUNAT_RUC_BASE_URL = os.environ.get('SUNAT_RUC_BASE_URL', 'https://e-consultaruc.sunat.gob.pe')
+RNSSC_BASE_URL = os.environ.get('RNSSC_BASE_URL', 'https://www.sanciones.gob.pe')
+# 'http': descarga directa y, si falla, con navegador; 'navegador': solo Selenium
+CONSTANCIAS_MODO = os.environ.get('CONSTANCIAS_MODO', 'http')
+PORTALES_TIMEOUT_CONEXION = 3.05
+
+# Ruta del chromedriver, resuelta una sola vez por proceso
+_chromedriver_path = None
+_chromedriver_lock = threading.Lock()
+
 # Configuración de logging minimalista
 def setup_logging(debug=False):
     """
@@ -44,23 +107,6 @@ def log_with_condition(logger, level, message, condition=False):
         elif level == 'error':
             logger.error(message)
 
-def timed_operation(func):
-    """
-    Decorador para medir tiempo de operaciones
-    """
-    def wrapper(*args, **kwargs):
-        logger = logging.getLogger('performance')
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        
-        # Solo loggeará si tarda más de 5 segundos
-        if end_time - start_time > 5:
-            logger.warning(f"{func.__name__} tardó {end_time - start_time:.2f} segundos")
-        
-        return result
-    return wrapper
-
 def safe_download(download_func):
     """
     Decorador para manejar errores de descarga
@@ -74,6 +120,16 @@ def safe_download(download_func):
             return None
     return wrapper
 
+def chromedriver_path():
+    """
+    Resuelve (y descarga si hace falta) el chromedriver una sola vez por proceso
+    """
+    global _chromedriver_path
+    with _chromedriver_lock:
+        if _chromedriver_path is None:
+            _chromedriver_path = ChromeDriverManager().install()
+        return _chromedriver_path
+
 def configure_selenium_driver(output_directory):
     """
     Configuración de driver Selenium optimizada
@@ -101,7 +157,7 @@ def configure_selenium_driver(output_directory):
 
         # Inicializar driver con timeout
         driver = webdriver.Chrome(
-            service=Service(ChromeDriverManager().install()), 
+            service=Service(chromedriver_path()), 
             options=chrome_options
         )
         
@@ -116,9 +172,451 @@ def configure_selenium_driver(output_directory):
         log_with_condition(logger, 'error', f"Error al configurar Selenium: {e}", condition=True)
         return None
 
+def set_download_directory(driver, output_directory):
+    """
+    Cambia la carpeta de descargas de un navegador ya iniciado
+    """
+    driver.execute_cdp_cmd('Browser.setDownloadBehavior', {
+        'behavior': 'allow',
+        'downloadPath': os.path.abspath(output_directory),
+    })
+
+def limpiar_datos_navegador(driver):
+    """
+    Borra cookies, caché y almacenamiento de los portales en todo el navegador.
+
+    driver.delete_all_cookies() solo borra las cookies de la página abierta, así
+    que se usa CDP, igual que set_download_directory.
+    """
+    driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+    driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+    for base in (RNP_BASE_URL, SUNAT_RUC_BASE_URL, RNSSC_BASE_URL):
+        partes = urlsplit(base)
+        driver.execute_cdp_cmd('Storage.clearDataForOrigin', {
+            'origin': f"{partes.scheme}://{partes.netloc}",
+            'storageTypes': 'all',
+        })
+
+class ChromeDriverPool:
+    """
+    Pool de navegadores Chrome headless reutilizables.
+
+    Los navegadores se crean bajo demanda hasta `size` y se devuelven al pool
+    tras cada uso, limpios de cookies y apuntando a la carpeta de descargas del
+    siguiente trabajo. Un navegador que falla, no responde o llegó a `max_usos`
+    se cierra y se reemplaza por uno nuevo.
+    """
+    def __init__(self, size=CHROME_POOL_SIZE, max_usos=CHROME_MAX_USOS):
+        self.size = size
+        self.max_usos = max_usos
+        self._libres = queue.LifoQueue()
+        self._usos = {}
+        self._creados = 0
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger('selenium_pool')
+
+    def _crear(self, output_directory):
+        driver = configure_selenium_driver(output_directory)
+        if driver is None:
+            raise RuntimeError("No se pudo configurar Selenium Driver")
+        self._usos[id(driver)] = 0
+        return driver
+
+    def _descartar(self, driver):
+        self._usos.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        with self._lock:
+            self._creados -= 1
+
+    def _sano(self, driver):
+        try:
+            return driver.execute_script('return 1') == 1
+        except Exception:
+            return False
+
+    def _reiniciar(self, driver, output_directory):
+        """
+        Deja el navegador como recién abierto: una sola pestaña en blanco, sin
+        cookies y descargando en `output_directory`
+        """
+        for handle in driver.window_handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(driver.window_handles[0])
+        driver.get('about:blank')
+        limpiar_datos_navegador(driver)
+        set_download_directory(driver, output_directory)
+
+    def precalentar(self, output_directory, cantidad=None):
+        """
+        Inicia navegadores por adelantado para que el primer uso no pague el arranque
+        """
+        cantidad = self.size if cantidad is None else min(cantidad, self.size)
+        while True:
+            with self._lock:
+                if self._creados >= cantidad:
+                    return
+                self._creados += 1
+            try:
+                self._libres.put(self._crear(output_directory))
+            except Exception as e:
+                with self._lock:
+                    self._creados -= 1
+                log_with_condition(self.logger, 'error', f"Error precalentando navegador: {e}", condition=True)
+                return
+
+    def adquirir(self, output_directory, timeout=CHROME_ESPERA_POOL):
+        """
+        Entrega un navegador listo para descargar en `output_directory`
+        """
+        limite = time.monotonic() + timeout
+        while True:
+            try:
+                driver = self._libres.get_nowait()
+            except queue.Empty:
+                driver = None
+                with self._lock:
+                    crear = self._creados < self.size
+                    if crear:
+                        self._creados += 1
+                if crear:
+                    try:
+                        driver = self._crear(output_directory)
+                    except Exception:
+                        with self._lock:
+                            self._creados -= 1
+                        raise
+                else:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        raise TimeoutError("No hay navegadores libres en el pool")
+                    try:
+                        driver = self._libres.get(timeout=restante)
+                    except queue.Empty:
+                        raise TimeoutError("No hay navegadores libres en el pool")
+
+            try:
+                if not self._sano(driver):
+                    raise RuntimeError("el navegador no responde")
+                self._reiniciar(driver, output_directory)
+                return driver
+            except Exception as e:
+                log_with_condition(self.logger, 'warning', f"Reemplazando navegador: {e}", condition=True)
+                self._descartar(driver)
+
+    def liberar(self, driver, fallido=False):
+        """
+        Devuelve un navegador al pool, o lo cierra si falló o agotó sus usos
+        """
+        usos = self._usos.get(id(driver), 0) + 1
+        self._usos[id(driver)] = usos
+        if fallido or usos >= self.max_usos or not self._sano(driver):
+            self._descartar(driver)
+        else:
+            self._libres.put(driver)
+
+    @contextmanager
+    def driver(self, output_directory, timeout=CHROME_ESPERA_POOL):
+        """
+        Uso: `with pool.driver(carpeta) as driver: ...`
+        """
+        driver = self.adquirir(output_directory, timeout)
+        fallido = False
+        try:
+            yield driver
+        except Exception:
+            fallido = True
+            raise
+        finally:
+            self.liberar(driver, fallido)
+
+    def cerrar(self):
+        """
+        Cierra los navegadores libres (los que están en uso se cierran al liberarse)
+        """
+        while True:
+            try:
+                self._descartar(self._libres.get_nowait())
+            except queue.Empty:
+                return
+
+def _crear_pool():
+    pool = ChromeDriverPool()
+    if CHROME_PRECALENTAR:
+        # Arrancar los navegadores en segundo plano; la carpeta se cambia al adquirirlos
+        threading.Thread(
+            target=pool.precalentar, args=(tempfile.gettempdir(),), daemon=True
+        ).start()
+    return pool
+
+def pool_drivers():
+    """
+    Pool de navegadores compartido por todo el proceso
+    """
+    return compartido('chrome_pool', _crear_pool)
+
+if Observer is not None:
+    class _AvisoCambios(FileSystemEventHandler):
+        """
+        Despierta al que espera ante cualquier cambio en la carpeta
+        """
+        def __init__(self, evento):
+            self.evento = evento
+
+        def on_any_event(self, event):
+            self.evento.set()
+
+@contextmanager
+def _observar_carpeta(directorio):
+    """
+    Entrega un threading.Event que se activa con cada cambio en `directorio`
+    (si no hay watchdog, nunca se activa y se revisa por intervalos)
+    """
+    evento = threading.Event()
+    observer = None
+    if Observer is not None:
+        try:
+            observer = Observer()
+            observer.schedule(_AvisoCambios(evento), directorio, recursive=False)
+            observer.start()
+        except Exception:
+            observer = None
+    try:
+        yield evento
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
+def _es_parcial(nombre):
+    return nombre.endswith(SUFIJOS_PARCIALES)
+
+def esperar_descarga(directorio, coincide, excluir=(), timeout=DESCARGA_TIMEOUT):
+    """
+    Espera a que termine de descargarse un archivo en `directorio`.
+
+    Un archivo está listo cuando su nombre cumple `coincide(nombre)`, no queda
+    ninguna descarga parcial (.crdownload) y su tamaño no cambió durante
+    DESCARGA_ESTABLE_S. Retorna apenas se cumple, sin esperas fijas.
+
+    Args:
+        directorio: Carpeta de descargas del navegador
+        coincide: Función que recibe el nombre del archivo
+        excluir: Nombres que ya estaban antes de iniciar la descarga
+        timeout: Plazo máximo en segundos
+
+    Returns:
+        str: Ruta del archivo descargado, o None si venció el plazo
+    """
+    limite = time.monotonic() + timeout
+    excluir = set(excluir)
+    vistos = {}
+
+    with _observar_carpeta(directorio) as evento:
+        while True:
+            evento.clear()
+            nombres = os.listdir(directorio)
+            ahora = time.monotonic()
+
+            if not any(_es_parcial(n) for n in nombres):
+                for nombre in sorted(nombres):
+                    if nombre in excluir or not coincide(nombre):
+                        continue
+                    try:
+                        tamano = os.path.getsize(os.path.join(directorio, nombre))
+                    except OSError:
+                        continue
+                    anterior = vistos.get(nombre)
+                    if anterior is None or anterior[0] != tamano:
+                        vistos[nombre] = (tamano, ahora)
+                    elif tamano > 0 and ahora - anterior[1] >= DESCARGA_ESTABLE_S:
+                        return os.path.join(directorio, nombre)
+
+            restante = limite - ahora
+            if restante <= 0:
+                return None
+            # Con inotify se despierta ante el primer cambio; el intervalo cubre
+            # la verificación de tamaño estable y el modo sin watchdog
+            espera = DESCARGA_ESTABLE_S if vistos else DESCARGA_INTERVALO_S
+            evento.wait(min(restante, espera))
+
+def esperar_descargas_pendientes(directorio, timeout=DESCARGA_TIMEOUT):
+    """
+    Espera a que no quede ninguna descarga parcial en `directorio`
+
+    Returns:
+        bool: True si la carpeta quedó sin parciales antes del plazo
+    """
+    limite = time.monotonic() + timeout
+    with _observar_carpeta(directorio) as evento:
+        while True:
+            evento.clear()
+            if not any(_es_parcial(n) for n in os.listdir(directorio)):
+                return True
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                return False
+            evento.wait(min(restante, DESCARGA_INTERVALO_S))
+
+def _adaptador_portales():
+    return compartido('adaptador_portales', lambda: HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=CONSTANCIAS_HILOS,
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=(502, 503, 504)),
+    ))
+
+def sesion_portales():
+    """
+    Sesión HTTP con cookies propias sobre el pool de conexiones compartido.
+
+    Las conexiones viven en el adaptador (uno por proceso) y se reutilizan entre
+    descargas; las cookies son de cada sesión, así dos consultas no se mezclan.
+    """
+    sesion = requests.Session()
+    adaptador = _adaptador_portales()
+    sesion.mount('http://', adaptador)
+    sesion.mount('https://', adaptador)
+    sesion.headers['User-Agent'] = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36'
+    return sesion
+
+BLOQUES_HTML = ('br', 'p', 'div', 'tr', 'li', 'table', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+def html_a_texto(html):
+    """
+    Texto visible de una página, con un salto de línea por bloque o fila
+    """
+    doc = lxml.html.fromstring(html)
+    for elemento in doc.xpath('//head|//script|//style|//button|//input|//select'):
+        elemento.drop_tree()
+    for elemento in doc.iter(*BLOQUES_HTML):
+        elemento.tail = '\n' + (elemento.tail or '')
+    for elemento in doc.iter('td', 'th'):
+        elemento.tail = ' ' + (elemento.tail or '')
+    lineas = (' '.join(linea.split()) for linea in doc.text_content().splitlines())
+    return '\n'.join(linea for linea in lineas if linea)
+
+# Navegación a una URL dentro del JavaScript de un botón o función de impresión
+PATRON_NAVEGACION = re.compile(r"""(?:location(?:\.href)?\s*=|window\.open\()\s*['"]([^'"]+)['"]""")
+
+def destino_impresion(html, url_pagina):
+    """
+    URL que abre el botón Imprimir de una página de resultados
+
+    Se busca en el onclick de #btnPrint o de los botones de impresión y, si
+    estos solo llaman a imprimir(), en los scripts de la página.
+
+    Returns:
+        str: URL absoluta, o None si la página no tiene un destino de impresión
+    """
+    doc = lxml.html.fromstring(html)
+    codigos = doc.xpath('//*[@id="btnPrint"]/@onclick')
+    codigos += doc.xpath('//*[contains(@onclick, "imprimir")]/@onclick')
+    codigos += [script.text_content() for script in doc.xpath('//script') if 'imprimir' in script.text_content()]
+    for codigo in codigos:
+        coincidencia = PATRON_NAVEGACION.search(codigo)
+        if coincidencia:
+            return urljoin(url_pagina, coincidencia.group(1))
+    return None
+
+def _descargar_impresion(sesion, respuesta, ruta, plazo):
+    """
+    Descarga con la misma sesión el PDF que el portal genera al imprimir y lo
+    guarda en `ruta`
+
+    Returns:
+        str: `ruta`, o None si no hay destino de impresión o no devuelve un PDF
+    """
+    logger = logging.getLogger('constancias_http')
+    if respuesta.content.startswith(b'%PDF-'):
+        contenido = respuesta.content
+    else:
+        url = destino_impresion(respuesta.content, respuesta.url)
+        if url is None:
+            log_with_condition(logger, 'warning', f"Sin botón de impresión en {respuesta.url}", condition=True)
+            return None
+        impresion = sesion.get(url, headers={'Referer': respuesta.url}, timeout=plazo)
+        impresion.raise_for_status()
+        if not impresion.content.startswith(b'%PDF-'):
+            log_with_condition(logger, 'warning', f"La impresión de {url} no es un PDF", condition=True)
+            return None
+        contenido = impresion.content
+
+    with open(ruta, 'wb') as f:
+        f.write(contenido)
+    return ruta
+
+@medido('rnp_http')
+def descargar_rnp_http(ruc, output_directory, timeout=DESCARGA_TIMEOUT):
+    """
+    Descarga la constancia RNP sin navegador: consulta el RUC y descarga el PDF
+    del botón Imprimir, como hace el navegador
+
+    Returns:
+        str: Ruta del PDF, o None si el portal no devolvió la constancia (se
+        intenta entonces con el navegador)
+    """
+    logger = logging.getLogger('rnp_download')
+    url = f"{RNP_BASE_URL}/Constancia/RNP_Constancia/default_Todos.asp"
+    sesion = sesion_portales()
+    plazo = (PORTALES_TIMEOUT_CONEXION, timeout)
+    respuesta = sesion.get(url, params={'RUC': ruc}, timeout=plazo)
+    respuesta.raise_for_status()
+
+    # Sin constancia el portal responde con una alerta y sin los datos del RUC
+    if not respuesta.content.startswith(b'%PDF-') and ruc not in html_a_texto(respuesta.content):
+        log_with_condition(logger, 'warning', f"RNP sin constancia para RUC {ruc}", condition=True)
+        return None
+
+    ruta = os.path.join(output_directory, f"RNP_{ruc}.pdf")
+    return _descargar_impresion(sesion, respuesta, ruta, plazo)
+
+@medido('ruc_http')
+def descargar_ruc_http(ruc, output_directory, timeout=DESCARGA_TIMEOUT):
+    """
+    Descarga la ficha RUC de SUNAT sin navegador: consulta el RUC y descarga el
+    PDF que genera imprimir()
+
+    Returns:
+        str: Ruta del PDF, o None si el portal no devolvió resultados o el PDF
+        (se intenta entonces con el navegador)
+    """
+    logger = logging.getLogger('sunat_download')
+    base = f"{SUNAT_RUC_BASE_URL}/cl-ti-itmrconsruc"
+    sesion = sesion_portales()
+    plazo = (PORTALES_TIMEOUT_CONEXION, timeout)
+
+    # La página del formulario entrega las cookies de la consulta
+    formulario = f"{base}/FrameCriterioBusquedaWeb.jsp"
+    sesion.get(formulario, timeout=plazo).raise_for_status()
+
+    respuesta = sesion.post(
+        f"{base}/jcrS00Alias",
+        data={
+            'accion': 'consPorRuc',
+            'nroRuc': ruc,
+            'contexto': 'ti-it',
+            'modo': '1',
+            # El formulario envía un token aleatorio generado en el navegador
+            'token': secrets.token_hex(26),
+        },
+        headers={'Referer': formulario},
+        timeout=plazo,
+    )
+    respuesta.raise_for_status()
+
+    if b'panel-primary' not in respuesta.content:
+        log_with_condition(logger, 'warning', f"SUNAT sin resultados para RUC {ruc}", condition=True)
+        return None
+
+    ruta = os.path.join(output_directory, f"SUNAT_{ruc}.pdf")
+    return _descargar_impresion(sesion, respuesta, ruta, plazo)
+
 @safe_download
-@timed_operation
-def download_rnp_certificate(ruc, output_directory, driver):
+@medido('rnp_navegador')
+def download_rnp_certificate(ruc, output_directory, driver, timeout=DESCARGA_TIMEOUT):
     """
     Descarga de certificado RNP con manejo de errores
     """
@@ -127,8 +625,9 @@ def download_rnp_certificate(ruc, output_directory, driver):
     try:
         log_with_condition(logger, 'info', f"Iniciando descarga RNP para RUC: {ruc}")
         
-        url = f"https://www.rnp.gob.pe/Constancia/RNP_Constancia/default_Todos.asp?RUC={ruc}"
+        url = f"{RNP_BASE_URL}/Constancia/RNP_Constancia/default_Todos.asp?RUC={ruc}"
         driver.get(url)
+        existentes = os.listdir(output_directory)
         
         # Manejar alertas
         try:
@@ -145,19 +644,20 @@ def download_rnp_certificate(ruc, output_directory, driver):
         )
         print_button.click()
         
-        time.sleep(3)
-        
-        # Buscar archivo descargado
-        archivos = os.listdir(output_directory)
-        pdf_rnp = [f for f in archivos if 'RNP_' in f and f.endswith('.pdf')]
-        
-        return os.path.join(output_directory, pdf_rnp[0]) if pdf_rnp else None
+        # Esperar el archivo descargado
+        return esperar_descarga(
+            output_directory,
+            lambda f: 'RNP_' in f and f.endswith('.pdf'),
+            excluir=existentes,
+            timeout=timeout
+        )
     
     except Exception as e:
         log_with_condition(logger, 'error', f"Error en descarga RNP: {e}", condition=True)
         return None
 
-def download_sunat_ruc_pdf(ruc, output_directory, driver):
+@medido('ruc_navegador')
+def download_sunat_ruc_pdf(ruc, output_directory, driver, timeout=DESCARGA_TIMEOUT):
     """
     Descarga de PDF de RUC SUNAT
     """
@@ -166,8 +666,9 @@ def download_sunat_ruc_pdf(ruc, output_directory, driver):
     try:
         log_with_condition(logger, 'info', f"Iniciando descarga RUC para: {ruc}")
         
-        url = 'https://e-consultaruc.sunat.gob.pe/cl-ti-itmrconsruc/FrameCriterioBusquedaWeb.jsp'
+        url = f"{SUNAT_RUC_BASE_URL}/cl-ti-itmrconsruc/FrameCriterioBusquedaWeb.jsp"
         driver.get(url)
+        existentes = os.listdir(output_directory)
         
         # Llenar formulario y buscar
         txt_ruc = WebDriverWait(driver, 10).until(
@@ -190,19 +691,19 @@ def download_sunat_ruc_pdf(ruc, output_directory, driver):
         )
         btn_imprimir.click()
         
-        time.sleep(3)
-        
-        # Buscar archivo descargado
-        archivos = os.listdir(output_directory)
-        pdf_ruc = [f for f in archivos if 'SUNAT_' in f and f.endswith('.pdf')]
-        
-        return os.path.join(output_directory, pdf_ruc[0]) if pdf_ruc else None
+        # Esperar el archivo descargado
+        return esperar_descarga(
+            output_directory,
+            lambda f: 'SUNAT_' in f and f.endswith('.pdf'),
+            excluir=existentes,
+            timeout=timeout
+        )
     
     except Exception as e:
         log_with_condition(logger, 'error', f"Error en descarga RUC: {e}", condition=True)
         return None
 
-def download_rnssc_pdf(dni, output_directory):
+def download_rnssc_pdf(dni, output_directory, timeout=30):
     """
     Descarga de PDF de RNSSC
     """
@@ -216,10 +717,10 @@ def download_rnssc_pdf(dni, output_directory):
         fecha_hora = now.strftime("%d-%m-%Y %H:%M:%S")
         
         # URL de descarga
-        url = f"https://www.sanciones.gob.pe/rnssc-rest/rest/sancion/descargar/Usuario%20consulta/NINGUNO/NINGUNO/NINGUNO/DOCUMENTO%20NACIONAL%20DE IDENTIDAD/{dni}/{fecha_hora}"
+        url = f"{RNSSC_BASE_URL}/rnssc-rest/rest/sancion/descargar/Usuario%20consulta/NINGUNO/NINGUNO/NINGUNO/DOCUMENTO%20NACIONAL%20DE IDENTIDAD/{dni}/{fecha_hora}"
         
         # Realizar solicitud
-        response = requests.get(url, timeout=30)
+        response = sesion_portales().get(url, timeout=(PORTALES_TIMEOUT_CONEXION, timeout))
         
         if response.status_code == 200:
             # Generar nombre de archivo
@@ -240,50 +741,252 @@ def download_rnssc_pdf(dni, output_directory):
         log_with_condition(logger, 'error', f"Error en descarga RNSSC: {e}", condition=True)
         return None
         
-def combinar_pdfs(output_directory, output_filename):
+def ordenar_constancias(constancias):
+    """
+    Rutas de las constancias en el orden en que se combinan
+
+    Args:
+        constancias: dict fuente -> ruta (se ordena RNP, RUC, RNSSC), lista de
+            rutas ya ordenada o una sola ruta (p. ej. un PDF ya combinado); las
+            rutas vacías o inexistentes se omiten
+    """
+    if isinstance(constancias, (str, os.PathLike)):
+        rutas = [constancias]
+    elif isinstance(constancias, dict):
+        rutas = [constancias.get(fuente) for fuente in ORDEN_CONSTANCIAS]
+        rutas += [ruta for fuente, ruta in constancias.items() if fuente not in ORDEN_CONSTANCIAS]
+    else:
+        rutas = list(constancias)
+    return [ruta for ruta in rutas if ruta and os.path.exists(ruta)]
+
+@medido('combinar')
+def preparar_combinacion(constancias):
+    """
+    Lee las constancias y prepara su combinación, sin escribir nada todavía
+
+    Las constancias ilegibles se omiten aquí, antes de empezar a escribir, para
+    que un PDF dañado no deje a medias el archivo de destino.
+
+    Args:
+        constancias: dict fuente -> ruta o lista de rutas (ver ordenar_constancias)
+
+    Returns:
+        function: escribir(flujo) que escribe el PDF combinado en un flujo binario
+        con write() y tell() (p. ej. la entrada de un ZIP), o None si no hay
+        ninguna constancia legible
+    """
+    logger = logging.getLogger('pdf_merger')
+    merger = PdfMerger()
+    agregadas = 0
+    for ruta in ordenar_constancias(constancias):
+        try:
+            merger.append(ruta)
+            agregadas += 1
+        except Exception as e:
+            log_with_condition(logger, 'warning', f"Se omite {ruta}: {e}", condition=True)
+
+    if not agregadas:
+        merger.close()
+        return None
+
+    log_with_condition(logger, 'info', f"PDFs a combinar: {agregadas}")
+
+    def escribir(flujo):
+        try:
+            merger.write(flujo)
+        finally:
+            merger.close()
+    return escribir
+
+def combinar_pdfs(output_directory, output_filename, archivos=None):
     """
     Combinación de PDFs con logging mínimo
+
+    Con `archivos` se combinan exactamente esas rutas, en ese orden; si no, se
+    buscan en `output_directory` los PDF con nombres de constancias.
     """
     logger = logging.getLogger('pdf_merger')
     
     try:
-        # Esperar a que se generen archivos
-        time.sleep(5)
-        
-        # Buscar PDFs con patrones flexibles
-        pdf_files = [
-            f for f in os.listdir(output_directory) 
-            if f.endswith('.pdf') and any(
-                keyword in f.upper() for keyword in 
-                ['RNP', 'SUNAT', 'RNSSC', 'CONSULTA']
+        if archivos is None:
+            # Esperar a que terminen las descargas en curso
+            if not esperar_descargas_pendientes(output_directory):
+                log_with_condition(logger, 'warning', "Quedaron descargas sin terminar", condition=True)
+            
+            # Buscar PDFs con patrones flexibles, en el orden RNP, RUC (SUNAT), RNSSC
+            claves = ['RNP', 'SUNAT', 'RNSSC', 'CONSULTA']
+            pdf_files = sorted(
+                (
+                    os.path.join(output_directory, f) for f in os.listdir(output_directory)
+                    if f.endswith('.pdf') and any(keyword in f.upper() for keyword in claves)
+                ),
+                key=lambda ruta: (
+                    next(i for i, k in enumerate(claves) if k in os.path.basename(ruta).upper()),
+                    os.path.basename(ruta),
+                ),
             )
-        ]
+        else:
+            pdf_files = [f for f in archivos if f]
         
         log_with_condition(logger, 'info', f"PDFs encontrados: {pdf_files}")
         
-        # Combinar PDFs
-        if pdf_files:
-            merger = PdfMerger()
-            for pdf in pdf_files:
-                full_path = os.path.join(output_directory, pdf)
-                merger.append(full_path)
-            
-            output_path = os.path.join(output_directory, output_filename)
-            merger.write(output_path)
-            merger.close()
-            
-            log_with_condition(logger, 'info', f"PDF combinado: {output_path}")
-            return output_path
+        escribir = preparar_combinacion(pdf_files)
+        if escribir is None:
+            return None
+
+        output_path = os.path.join(output_directory, output_filename)
+        with open(output_path, 'wb') as f:
+            escribir(f)
         
-        return None
+        log_with_condition(logger, 'info', f"PDF combinado: {output_path}")
+        return output_path
     
     except Exception as e:
         log_with_condition(logger, 'error', f"Error combinando PDFs: {e}", condition=True)
         return None
 
-def descargar_constancias(ruc, dni, output_directory):
+def _descargar_con_navegador(descarga, ruc, output_directory, timeout):
+    """
+    Ejecuta una descarga de Selenium con un navegador tomado del pool
+    """
+    with pool_drivers().driver(output_directory, timeout=timeout) as driver:
+        return descarga(ruc, output_directory, driver, timeout=timeout)
+
+def _descargar_con_respaldo(descarga_http, descarga_navegador, ruc, output_directory, limite):
+    """
+    Intenta la descarga directa por HTTP y, si no resulta, la hace con Selenium
+
+    Cada intento usa como timeout lo que queda hasta `limite` (time.monotonic)
+    """
+    logger = logging.getLogger('constancias')
+    if CONSTANCIAS_MODO == 'http':
+        try:
+            ruta = descarga_http(ruc, output_directory, timeout=limite - time.monotonic())
+            if ruta:
+                return ruta
+        except Exception as e:
+            log_with_condition(logger, 'warning',
+                               f"{descarga_http.__name__} falló, se usa el navegador: {e}", condition=True)
+
+    restante = limite - time.monotonic()
+    if restante <= 0:
+        log_with_condition(logger, 'warning', f"RUC {ruc}: el plazo venció antes de usar el navegador", condition=True)
+        return None
+    return _descargar_con_navegador(descarga_navegador, ruc, output_directory, restante)
+
+def _medir_fuente(fuente, tarea, carpeta, limite):
+    # Una tarea que esperó en cola hasta vencer su plazo ya no se ejecuta
+    if time.monotonic() >= limite:
+        log_with_condition(logging.getLogger('constancias'), 'warning',
+                           f"{fuente}: el plazo venció antes de empezar", condition=True)
+        return None
+    with tramo(f"constancia_{fuente.lower()}"):
+        return tarea(carpeta, limite)
+
+def _executor_constancias():
+    return compartido(
+        'constancias_executor',
+        lambda: ThreadPoolExecutor(max_workers=CONSTANCIAS_HILOS, thread_name_prefix='constancias')
+    )
+
+def _es_pdf(ruta):
+    try:
+        with open(ruta, 'rb') as f:
+            return f.read(5) == b'%PDF-'
+    except OSError:
+        return False
+
+def descargar_fuentes(ruc, dni, output_directory, timeouts=None, usar_almacen=True):
+    """
+    Descarga las constancias RNP, RUC y RNSSC en paralelo.
+
+    Cada fuente descarga en su propia subcarpeta y tiene su propio plazo, así el
+    tiempo total es el de la fuente más lenta. Una fuente que falla o vence su
+    plazo no impide devolver las demás. Las constancias ya descargadas hoy para
+    el mismo RUC/DNI se toman del almacén sin abrir el navegador.
+
+    Args:
+        ruc: RUC del proveedor
+        dni: DNI del proveedor
+        output_directory: Carpeta base de las descargas
+        timeouts: Plazos por fuente (por defecto TIMEOUTS_CONSTANCIAS)
+        usar_almacen: Consultar y alimentar el almacén de constancias
+
+    Returns:
+        dict: Ruta del PDF (o None) por fuente, en el orden RNP, RUC, RNSSC
+    """
+    logger = logging.getLogger('constancias')
+    timeouts = {**TIMEOUTS_CONSTANCIAS, **(timeouts or {})}
+
+    # Cada tarea recibe su límite (time.monotonic) y ajusta sus timeouts a él
+    tareas = {
+        'RNP': lambda carpeta, limite: _descargar_con_respaldo(
+            descargar_rnp_http, download_rnp_certificate, ruc, carpeta, limite),
+        'RUC': lambda carpeta, limite: _descargar_con_respaldo(
+            descargar_ruc_http, download_sunat_ruc_pdf, ruc, carpeta, limite),
+        'RNSSC': lambda carpeta, limite: download_rnssc_pdf(
+            dni, carpeta, timeout=limite - time.monotonic()),
+    }
+
+    identificadores = {'RNP': ruc, 'RUC': ruc, 'RNSSC': dni}
+    almacen = almacen_constancias() if usar_almacen else None
+
+    inicio = time.monotonic()
+    resultados = {}
+    futuros = {}
+    for fuente, tarea in tareas.items():
+        if almacen is not None:
+            guardada = almacen.obtener(fuente, identificadores[fuente])
+            if guardada:
+                resultados[fuente] = guardada
+                continue
+        carpeta = os.path.join(output_directory, fuente.lower())
+        # Una carpeta vacía por fuente: ninguna descarga ve archivos de otra
+        shutil.rmtree(carpeta, ignore_errors=True)
+        os.makedirs(carpeta)
+        # Cada fuente es un tramo de la traza de quien pidió las constancias
+        futuros[fuente] = _executor_constancias().submit(
+            en_contexto(_medir_fuente), fuente, tarea, carpeta, inicio + timeouts[fuente]
+        )
+
+    for fuente, futuro in futuros.items():
+        # Los plazos cuentan desde el inicio común, no desde que se espera cada uno
+        restante = max(0.0, inicio + timeouts[fuente] - time.monotonic())
+        try:
+            resultados[fuente] = futuro.result(timeout=restante)
+        except FuturoTimeout:
+            # Si aún estaba en cola no llega a empezar; si ya corre, sus timeouts
+            # vencen junto con el plazo
+            futuro.cancel()
+            log_with_condition(logger, 'error', f"{fuente}: sin respuesta en {timeouts[fuente]:g} s", condition=True)
+            resultados[fuente] = None
+        except Exception as e:
+            log_with_condition(logger, 'error', f"{fuente}: {e}", condition=True)
+            resultados[fuente] = None
+
+        ruta = resultados[fuente]
+        if ruta and almacen is not None and _es_pdf(ruta):
+            try:
+                resultados[fuente] = almacen.guardar(fuente, identificadores[fuente], ruta)
+            except OSError as e:
+                log_with_condition(logger, 'warning', f"No se pudo guardar {fuente} en el almacén: {e}", condition=True)
+        log_with_condition(logger, 'info', f"Resultado {fuente}: {resultados[fuente]}",
+                           condition=resultados[fuente] is None)
+
+    # Mantener el orden RNP, RUC, RNSSC aunque algunas vengan del almacén
+    return {fuente: resultados.get(fuente) for fuente in tareas}
+
+def descargar_constancias(ruc, dni, output_directory, espacio=None):
     """
     Función principal de descarga de constancias
+
+    No combina los PDF: eso lo hace quien arma el ZIP, escribiendo el combinado
+    directo en su entrada (ver preparar_combinacion). Si se pasa el
+    EspacioTrabajo del trabajo, en él se registra cada PDF descargado.
+
+    Returns:
+        dict: fuente -> ruta del PDF (o None si no se obtuvo), en el orden
+        RNP, RUC, RNSSC
     """
     logger = logging.getLogger('constancias')
     
@@ -291,48 +994,16 @@ def descargar_constancias(ruc, dni, output_directory):
         # Preparar directorio
         os.makedirs(output_directory, exist_ok=True)
         
-        # Configurar driver
-        driver = configure_selenium_driver(output_directory)
-        
-        if not driver:
-            log_with_condition(logger, 'error', "No se pudo configurar Selenium Driver", condition=True)
-            return None
-        
-        try:
-            # Intentar descargas
-            log_with_condition(logger, 'info', f"Iniciando descargas para RUC: {ruc}, DNI: {dni}")
-            
-            # Descargar RNP
-            rnp_result = download_rnp_certificate(ruc, output_directory, driver)
-            log_with_condition(logger, 'info', f"Resultado RNP: {rnp_result}", 
-                               condition=rnp_result is None)
-            
-            # Descargar RUC SUNAT
-            ruc_result = download_sunat_ruc_pdf(ruc, output_directory, driver)
-            log_with_condition(logger, 'info', f"Resultado RUC: {ruc_result}", 
-                               condition=ruc_result is None)
-            
-            # Descargar RNSSC
-            rnssc_result = download_rnssc_pdf(dni, output_directory)
-            log_with_condition(logger, 'info', f"Resultado RNSSC: {rnssc_result}", 
-                               condition=rnssc_result is None)
-            
-            # Combinar PDFs
-            output_filename = '5. RNP, RUC, RNSSC.pdf'
-            combined_pdf = combinar_pdfs(output_directory, output_filename)
-            
-            if combined_pdf:
-                log_with_condition(logger, 'info', f"PDF combinado generado: {combined_pdf}")
-                return combined_pdf
-            else:
-                log_with_condition(logger, 'warning', "No se pudo combinar PDFs", condition=True)
-                return None
+        log_with_condition(logger, 'info', f"Iniciando descargas para RUC: {ruc}, DNI: {dni}")
+        resultados = descargar_fuentes(ruc, dni, output_directory)
+        if espacio is not None:
+            for fuente, ruta in resultados.items():
+                espacio.registrar(fuente, ruta)
         
-        finally:
-            # Siempre cerrar el driver
-            if driver:
-                driver.quit()
+        if not any(resultados.values()):
+            log_with_condition(logger, 'warning', "No se obtuvo ninguna constancia", condition=True)
+        return resultados
     
     except Exception as e:
         log_with_condition(logger, 'error', f"Error en descarga de constancias: {e}", condition=True)
-        return None
+        return {}
@@ -0,0 +1,259 @@
+# cotizar_lote.py
+"""
+Generación de cotizaciones en lote, sin Streamlit.
+
+Uso:
+    python cotizar_lote.py CARPETA_TDR perfil.json [--salida CARPETA] [--procesos N] [--motor docx|xml]
+                           [--token-sunat TOKEN]
+
+El perfil del proveedor es un JSON con las mismas claves del formulario:
+
+    {
+        "dni": "12345678",
+        "nombres": "...",            (opcional, se consulta en SUNAT si falta)
+        "ruc": "...",                (opcional, se consulta en SUNAT si falta)
+        "telefono": "...",
+        "correo": "...",
+        "direccion": "...",
+        "banco": "BCP",
+        "cuenta": "...",
+        "cci": "...",                (opcional, se calcula con generar_cci)
+        "firma": "firma.png",        (ruta relativa al perfil)
+        "remover_fondo": false,
+        "constancias": "5. RNP, RUC, RNSSC.pdf",   (opcional)
+        "oferta": 2500.0,            (opcional, monto fijo para todos los TDR)
+        "reglas_precio": [[30, 2000.0], [60, 4000.0]]   (opcional, [hasta_dias, monto])
+    }
+
+Sin "oferta" ni "reglas_precio" se usa obtener_valor_sugerido. La consulta a
+SUNAT usa el token de apis.net.pe de --token-sunat o de la variable APISNET_KEY.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from io import BytesIO
+
+import requests
+
+import app
+from trazas import traza
+
+def cargar_perfil(ruta_perfil, token_sunat=None):
+    """
+    Lee el perfil del proveedor y resuelve las rutas relativas al archivo
+
+    Si faltan "nombres" o "ruc" se consultan en SUNAT con `token_sunat` (por
+    defecto, la variable de entorno APISNET_KEY).
+
+    Raises:
+        ValueError: Perfil incompleto o consulta a SUNAT fallida
+    """
+    try:
+        with open(ruta_perfil, encoding='utf-8') as f:
+            perfil = json.load(f)
+    except OSError as e:
+        raise ValueError(f"No se pudo leer el perfil {ruta_perfil}: {e.strerror or e}")
+    except json.JSONDecodeError as e:
+        raise ValueError(f"El perfil {ruta_perfil} no es un JSON válido: {e}")
+    if not isinstance(perfil, dict):
+        raise ValueError(f"El perfil {ruta_perfil} debe ser un objeto JSON")
+
+    base = os.path.dirname(os.path.abspath(ruta_perfil))
+    for clave in ('firma', 'constancias'):
+        if perfil.get(clave):
+            perfil[clave] = os.path.join(base, perfil[clave])
+
+    faltantes = [
+        clave for clave in ('dni', 'telefono', 'correo', 'direccion', 'banco', 'cuenta', 'firma')
+        if not perfil.get(clave)
+    ]
+    if faltantes:
+        raise ValueError(f"Faltan campos en el perfil: {', '.join(faltantes)}")
+
+    # Se revisa antes de iniciar los procesos, no a mitad del lote
+    for clave in ('firma', 'constancias'):
+        if perfil.get(clave) and not os.path.isfile(perfil[clave]):
+            raise ValueError(f"No existe el archivo de '{clave}': {perfil[clave]}")
+
+    if not perfil.get('cci'):
+        perfil['cci'] = app.generar_cci(perfil['banco'], perfil['cuenta'])
+
+    if not perfil.get('nombres') or not perfil.get('ruc'):
+        token = token_sunat or os.environ.get('APISNET_KEY')
+        if not token:
+            raise ValueError(
+                "Faltan 'nombres' o 'ruc' en el perfil y no hay token de apis.net.pe "
+                "para consultarlos (usa --token-sunat o APISNET_KEY)"
+            )
+        try:
+            nombres, ruc = app.cliente_sunat().consultar(perfil['dni'], token)
+        except requests.RequestException as e:
+            raise ValueError(f"Error al conectar con la API de SUNAT: {e}")
+        if not nombres:
+            raise ValueError(f"No se pudo obtener datos de SUNAT para el DNI {perfil['dni']}")
+        perfil['nombres'], perfil['ruc'] = nombres, ruc
+
+    return perfil
+
+def calcular_oferta(perfil, dias):
+    """
+    Aplica el monto fijo o las reglas de precio del perfil según los días del TDR
+    """
+    if perfil.get('oferta'):
+        return float(perfil['oferta'])
+
+    reglas = perfil.get('reglas_precio')
+    if reglas:
+        try:
+            dias = int(dias)
+        except (ValueError, TypeError):
+            return float(reglas[0][1])
+        for hasta_dias, monto in sorted(reglas):
+            if dias <= hasta_dias:
+                return float(monto)
+        return float(sorted(reglas)[-1][1])
+
+    return app.obtener_valor_sugerido(dias)
+
+def _generar_zip_tdr(ruta_pdf, perfil, firma_png, salida, motor=None):
+    """
+    Analiza un TDR, genera su cotización y escribe el ZIP en la carpeta de salida
+    """
+    with open(ruta_pdf, 'rb') as f:
+        contenido = f.read()
+
+    tdr = app.parse_tdr(BytesIO(contenido))
+    fecha_formateada, mes_actual = app.formatear_fecha(datetime.now())
+
+    data = {
+        'dni': perfil['dni'],
+        'nombres': perfil['nombres'],
+        'ruc': perfil['ruc'],
+        'telefono': perfil['telefono'],
+        'correo': perfil['correo'],
+        'direccion': perfil['direccion'],
+        'banco': perfil['banco'],
+        'cuenta': perfil['cuenta'],
+        'cci': perfil['cci'],
+        'oferta': calcular_oferta(perfil, tdr.dias),
+        'fecha': fecha_formateada,
+        'year': datetime.now().year,
+        'mes': mes_actual,
+        'firma': BytesIO(firma_png),
+    }
+
+    doc_io = app.generar_cotizacion(ruta_pdf, data, tdr=tdr, motor=motor)
+    nombre_zip = os.path.splitext(os.path.basename(ruta_pdf))[0] + '.zip'
+    ruta_zip = os.path.join(salida, nombre_zip)
+    # El ZIP se escribe directo en disco y el TDR se copia desde su archivo
+    app.empaquetar_cotizacion(doc_io, firma_png, ruta_pdf, perfil.get('constancias'), destino=ruta_zip)
+
+    return ruta_zip
+
+def _cotizar_tdr(ruta_pdf, perfil, firma_png, salida, motor=None):
+    """
+    Trabajo de un proceso: devuelve (ruta_zip, segundos, error) medidos en el propio proceso
+    """
+    inicio = time.perf_counter()
+    try:
+        with traza():
+            ruta_zip = _generar_zip_tdr(ruta_pdf, perfil, firma_png, salida, motor)
+        return ruta_zip, time.perf_counter() - inicio, None
+    except Exception as e:
+        return None, time.perf_counter() - inicio, f"{type(e).__name__}: {e}"
+
+def cotizar_lote(carpeta, perfil, salida, procesos=None, motor=None):
+    """
+    Genera una cotización por cada PDF de la carpeta repartiendo el trabajo en procesos
+
+    Returns:
+        list: (archivo, ruta_zip o None, segundos, error o None) por cada TDR
+
+    Raises:
+        ValueError: La firma no se puede leer o no es una imagen
+    """
+    logger = logging.getLogger('cotizar_lote')
+
+    pdfs = sorted(
+        os.path.join(carpeta, f) for f in os.listdir(carpeta)
+        if f.lower().endswith('.pdf')
+    )
+    os.makedirs(salida, exist_ok=True)
+
+    # La firma se procesa una sola vez y se comparte con todos los procesos
+    try:
+        with open(perfil['firma'], 'rb') as f:
+            firma_png = app.procesar_firma(f, perfil.get('remover_fondo', False)).getvalue()
+    except OSError as e:
+        # Incluye PIL.UnidentifiedImageError: el archivo no es una imagen
+        raise ValueError(f"No se pudo procesar la firma {perfil['firma']}: {e}")
+
+    resultados = []
+    # "spawn" en lugar de "fork": las librerías que importa app.py (onnxruntime,
+    # streamlit) dejan hilos y locks que bloquean a los procesos hijos al bifurcar
+    contexto = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=procesos, mp_context=contexto) as executor:
+        futuros = {
+            executor.submit(_cotizar_tdr, ruta_pdf, perfil, firma_png, salida, motor): ruta_pdf
+            for ruta_pdf in pdfs
+        }
+        for futuro in as_completed(futuros):
+            nombre = os.path.basename(futuros[futuro])
+            try:
+                ruta_zip, segundos, error = futuro.result()
+            except Exception as e:
+                # El proceso murió antes de poder informar su resultado
+                ruta_zip, segundos, error = None, 0.0, f"{type(e).__name__}: {e}"
+
+            if error:
+                logger.error(f"{nombre}: error tras {segundos:.2f} s: {error}")
+            else:
+                logger.info(f"{nombre}: {segundos:.2f} s -> {ruta_zip}")
+            resultados.append((nombre, ruta_zip, segundos, error))
+
+    return resultados
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera cotizaciones para una carpeta de TDR")
+    parser.add_argument('carpeta', help="Carpeta con los TDR en PDF")
+    parser.add_argument('perfil', help="Perfil del proveedor en JSON")
+    parser.add_argument('--salida', help="Carpeta de los ZIP (por defecto CARPETA/cotizaciones)")
+    parser.add_argument('--procesos', type=int, default=None, help="Número de procesos (por defecto, uno por núcleo)")
+    parser.add_argument('--motor', choices=['docx', 'xml'], default=None, help="Motor de generación del DOCX (por defecto MOTOR_COTIZACION)")
+    parser.add_argument('--token-sunat', default=None, help="Token de apis.net.pe (por defecto APISNET_KEY)")
+    args = parser.parse_args(argv)
+
+    try:
+        perfil = cargar_perfil(args.perfil, args.token_sunat)
+    except ValueError as e:
+        print(f"Perfil inválido: {e}", file=sys.stderr)
+        return 2
+    if not os.path.isdir(args.carpeta):
+        print(f"No existe la carpeta de TDR: {args.carpeta}", file=sys.stderr)
+        return 2
+    salida = args.salida or os.path.join(args.carpeta, 'cotizaciones')
+
+    inicio = time.perf_counter()
+    try:
+        resultados = cotizar_lote(args.carpeta, perfil, salida, args.procesos, args.motor)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    total = time.perf_counter() - inicio
+
+    fallidos = [r for r in resultados if r[3]]
+    print(f"\n{len(resultados) - len(fallidos)}/{len(resultados)} cotizaciones generadas en {total:.2f} s")
+    for nombre, _, segundos, error in sorted(resultados):
+        estado = f"ERROR: {error}" if error else "ok"
+        print(f"  {nombre:<50} {segundos:8.2f} s  {estado}")
+
+    return 1 if fallidos else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
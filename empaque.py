@@ -0,0 +1,163 @@
+# empaque.py
+import os
+import shutil
+import time
+import zipfile
+import zlib
+from io import BytesIO
+
+# Tamaño de los bloques copiados al ZIP y de la muestra para decidir la compresión
+BLOQUE_ZIP = 1024 * 1024
+MUESTRA_COMPRESION = 64 * 1024
+# Si la muestra no baja de esta proporción al comprimirla, se guarda sin comprimir
+UMBRAL_COMPRESION = 0.9
+
+# Formatos que ya vienen comprimidos: no vale la pena pasarlos por DEFLATE
+EXTENSIONES_COMPRIMIDAS = {
+    '.png', '.jpg', '.jpeg', '.gif', '.webp',
+    '.zip', '.docx', '.xlsx', '.pptx', '.odt', '.gz', '.7z', '.rar',
+}
+
+def elegir_compresion(nombre, muestra):
+    """
+    STORED para formatos ya comprimidos o contenido que no se reduce, si no DEFLATED
+
+    Args:
+        nombre: Nombre de la entrada (se usa su extensión)
+        muestra: Primeros bytes del contenido
+    """
+    if os.path.splitext(nombre)[1].lower() in EXTENSIONES_COMPRIMIDAS:
+        return zipfile.ZIP_STORED
+    muestra = bytes(muestra[:MUESTRA_COMPRESION])
+    if not muestra:
+        return zipfile.ZIP_STORED
+    # Nivel 1: solo se busca saber si el contenido se comprime, y rápido
+    if len(zlib.compress(muestra, 1)) > len(muestra) * UMBRAL_COMPRESION:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def _info_entrada(nombre, muestra):
+    info = zipfile.ZipInfo(nombre, date_time=time.localtime()[:6])
+    info.compress_type = elegir_compresion(nombre, muestra)
+    info.external_attr = 0o644 << 16
+    return info
+
+class EscrituraEntrada:
+    """
+    Flujo binario de escritura hacia una entrada del ZIP, para quien genera el
+    contenido (p. ej. un PDF combinado) en vez de tenerlo en un archivo.
+
+    Retiene los primeros MUESTRA_COMPRESION bytes para elegir la compresión y
+    luego escribe directo en la entrada. Ofrece `tell()` (posición escrita),
+    que algunos escritores de PDF necesitan.
+    """
+    def __init__(self, zipf, nombre):
+        self._zipf = zipf
+        self._nombre = nombre
+        self._muestra = bytearray()
+        self._destino = None
+        self._posicion = 0
+
+    def _abrir(self):
+        info = _info_entrada(self._nombre, self._muestra)
+        # El tamaño final no se conoce de antemano
+        self._destino = self._zipf.open(info, 'w', force_zip64=True)
+        self._destino.write(self._muestra)
+        self._muestra = None
+
+    def write(self, datos):
+        if self._destino is None:
+            self._muestra += datos
+            if len(self._muestra) >= MUESTRA_COMPRESION:
+                self._abrir()
+        else:
+            self._destino.write(datos)
+        self._posicion += len(datos)
+        return len(datos)
+
+    def tell(self):
+        return self._posicion
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._destino is None:
+            self._abrir()
+        self._destino.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def agregar_entrada(zipf, nombre, fuente):
+    """
+    Copia una fuente al ZIP por bloques, sin armar una copia completa en memoria
+
+    Args:
+        zipf: zipfile.ZipFile abierto para escritura
+        nombre: Nombre de la entrada dentro del ZIP
+        fuente: Ruta de archivo, bytes, BytesIO, archivo abierto en modo binario
+            o una función `escribir(flujo)` que genera el contenido
+    """
+    if callable(fuente):
+        with EscrituraEntrada(zipf, nombre) as destino:
+            fuente(destino)
+        return
+
+    vista = archivo = None
+    if isinstance(fuente, (str, os.PathLike)):
+        archivo = open(fuente, 'rb')
+        tamano = os.path.getsize(fuente)
+    elif isinstance(fuente, BytesIO):
+        # Se lee el buffer del BytesIO directamente, sin getvalue()
+        vista = fuente.getbuffer()
+    elif isinstance(fuente, (bytes, bytearray, memoryview)):
+        vista = memoryview(fuente)
+    else:
+        archivo = fuente
+        archivo.seek(0)
+        tamano = None
+
+    try:
+        if vista is not None:
+            tamano = len(vista)
+            muestra = vista[:MUESTRA_COMPRESION]
+        else:
+            muestra = archivo.read(MUESTRA_COMPRESION)
+
+        info = _info_entrada(nombre, muestra)
+        zip64 = tamano is None or tamano > zipfile.ZIP64_LIMIT
+
+        with zipf.open(info, 'w', force_zip64=zip64) as destino:
+            if vista is not None:
+                for inicio in range(0, tamano, BLOQUE_ZIP):
+                    destino.write(vista[inicio:inicio + BLOQUE_ZIP])
+            else:
+                destino.write(muestra)
+                shutil.copyfileobj(archivo, destino, BLOQUE_ZIP)
+    finally:
+        if vista is not None:
+            muestra = None
+            vista.release()
+        if archivo is not None and archivo is not fuente:
+            archivo.close()
+
+def escribir_zip(destino, entradas):
+    """
+    Escribe un ZIP con las entradas dadas, eligiendo la compresión de cada una
+
+    Args:
+        destino: Ruta o archivo binario donde se escribe el ZIP
+        entradas: Pares (nombre en el ZIP, fuente); las fuentes None se omiten
+
+    Returns:
+        El mismo `destino`
+    """
+    with zipfile.ZipFile(destino, mode='w') as zipf:
+        for nombre, fuente in entradas:
+            if fuente is not None:
+                agregar_entrada(zipf, nombre, fuente)
+    return destino
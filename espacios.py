@@ -0,0 +1,182 @@
+# espacios.py
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from cache import compartido
+
+# Carpeta raíz de los espacios de trabajo y límites de la limpieza
+ESPACIOS_RAIZ = os.environ.get(
+    'ESPACIOS_RAIZ',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'temp_downloads')
+)
+ESPACIOS_MAX_EDAD = float(os.environ.get('ESPACIOS_MAX_EDAD', str(60 * 60)))
+ESPACIOS_MAX_BYTES = int(os.environ.get('ESPACIOS_MAX_BYTES', str(500 * 1024 * 1024)))
+ESPACIOS_INTERVALO_LIMPIEZA = float(os.environ.get('ESPACIOS_INTERVALO_LIMPIEZA', str(5 * 60)))
+
+class EspacioTrabajo:
+    """
+    Carpeta exclusiva de un trabajo de cotización.
+
+    Cada archivo que produce el trabajo se registra con una etiqueta, así nadie
+    tiene que adivinar qué archivos le pertenecen buscando por nombre.
+    """
+    def __init__(self, gestor, id_trabajo, ruta):
+        self.gestor = gestor
+        self.id = id_trabajo
+        self.ruta = ruta
+        self._archivos = {}
+
+    def ruta_para(self, nombre):
+        """
+        Ruta dentro del espacio para un archivo (o subcarpeta) nuevo
+        """
+        return os.path.join(self.ruta, nombre)
+
+    def registrar(self, etiqueta, ruta):
+        """
+        Anota que `ruta` es el archivo `etiqueta` de este trabajo. Ignora None.
+        """
+        if ruta:
+            self._archivos[etiqueta] = ruta
+        return ruta
+
+    def archivo(self, etiqueta):
+        return self._archivos.get(etiqueta)
+
+    def archivos(self):
+        """
+        Archivos registrados, en el orden en que se registraron
+        """
+        return dict(self._archivos)
+
+    def liberar(self):
+        self.gestor.liberar(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.liberar()
+
+    def __repr__(self):
+        return f"EspacioTrabajo({self.id!r}, archivos={list(self._archivos)})"
+
+class GestorEspacios:
+    """
+    Crea espacios de trabajo bajo `raiz` y elimina los viejos.
+
+    La limpieza borra los espacios liberados con más de `max_edad` segundos y,
+    si la carpeta sigue ocupando más de `max_bytes`, los más antiguos hasta
+    quedar dentro del límite. Los espacios en uso nunca se borran.
+    """
+    def __init__(self, raiz=ESPACIOS_RAIZ, max_edad=ESPACIOS_MAX_EDAD, max_bytes=ESPACIOS_MAX_BYTES):
+        self.raiz = raiz
+        self.max_edad = max_edad
+        self.max_bytes = max_bytes
+        self._en_uso = set()
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = None
+        self.logger = logging.getLogger('espacios')
+        os.makedirs(raiz, exist_ok=True)
+
+    def crear(self):
+        """
+        Crea un espacio vacío con un id único
+        """
+        id_trabajo = uuid.uuid4().hex
+        ruta = os.path.join(self.raiz, id_trabajo)
+        with self._lock:
+            self._en_uso.add(id_trabajo)
+        os.makedirs(ruta)
+        return EspacioTrabajo(self, id_trabajo, ruta)
+
+    def liberar(self, espacio):
+        """
+        Marca el espacio como terminado; desde ahora la limpieza puede borrarlo
+        """
+        with self._lock:
+            self._en_uso.discard(espacio.id)
+        try:
+            # La edad se cuenta desde que se liberó
+            os.utime(espacio.ruta)
+        except OSError:
+            pass
+
+    def _tamano(self, ruta):
+        total = 0
+        for carpeta, _, archivos in os.walk(ruta):
+            for nombre in archivos:
+                try:
+                    total += os.path.getsize(os.path.join(carpeta, nombre))
+                except OSError:
+                    pass
+        return total
+
+    def limpiar(self):
+        """
+        Una pasada de limpieza. Retorna la cantidad de espacios eliminados.
+        """
+        ahora = time.time()
+        espacios = []
+        for entrada in os.scandir(self.raiz):
+            if not entrada.is_dir(follow_symlinks=False):
+                continue
+            try:
+                modificado = entrada.stat().st_mtime
+            except OSError:
+                continue
+            espacios.append((modificado, entrada.name, entrada.path, self._tamano(entrada.path)))
+
+        # Del más antiguo al más nuevo
+        espacios.sort()
+        total = sum(tamano for *_, tamano in espacios)
+        eliminados = 0
+        for modificado, nombre, ruta, tamano in espacios:
+            with self._lock:
+                if nombre in self._en_uso:
+                    continue
+            viejo = ahora - modificado > self.max_edad
+            if not viejo and total <= self.max_bytes:
+                continue
+            shutil.rmtree(ruta, ignore_errors=True)
+            total -= tamano
+            eliminados += 1
+
+        if eliminados:
+            self.logger.info(f"Espacios eliminados: {eliminados}, ocupado: {total / 1024 / 1024:.1f} MB")
+        return eliminados
+
+    def iniciar_limpieza(self, intervalo=ESPACIOS_INTERVALO_LIMPIEZA):
+        """
+        Ejecuta la limpieza en un hilo de fondo cada `intervalo` segundos
+        """
+        def ciclo():
+            while not self._detener.wait(intervalo):
+                try:
+                    self.limpiar()
+                except Exception as e:
+                    self.logger.error(f"Error limpiando espacios: {e}")
+
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=ciclo, name='limpieza_espacios', daemon=True)
+            self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+
+def _crear_gestor():
+    gestor = GestorEspacios()
+    gestor.limpiar()
+    gestor.iniciar_limpieza()
+    return gestor
+
+def gestor_espacios():
+    """
+    Gestor de espacios compartido por todo el proceso
+    """
+    return compartido('espacios', _crear_gestor)
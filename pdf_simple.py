@@ -0,0 +1,88 @@
+# pdf_simple.py
+"""
+Escritor mínimo de PDF de solo texto, en Python puro.
+
+Lo usa benchmark.py para generar los TDR y constancias sintéticos de prueba,
+sin librerías adicionales.
+"""
+import zlib
+
+# Página A4 en puntos, márgenes y tipografía
+ANCHO_PAGINA = 595
+ALTO_PAGINA = 842
+MARGEN = 56
+TAMANO_LETRA = 10
+INTERLINEA = 14
+
+def _escapar(texto):
+    # Helvetica con WinAnsiEncoding cubre los caracteres del español
+    crudo = texto.encode('cp1252', errors='replace')
+    return crudo.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+def _contenido_pagina(lineas):
+    partes = [b'BT', f'/F1 {TAMANO_LETRA} Tf {INTERLINEA} TL {MARGEN} {ALTO_PAGINA - MARGEN} Td'.encode()]
+    for linea in lineas:
+        partes.append(b'(' + _escapar(linea) + b") '")
+    partes.append(b'ET')
+    return b'\n'.join(partes)
+
+def escribir_pdf(paginas, titulo=None, comprimir=True):
+    """
+    Genera un PDF con una página por cada lista de líneas
+
+    Args:
+        paginas: Lista de páginas; cada página es una lista de líneas de texto
+        titulo: Título opcional en los metadatos
+        comprimir: Comprimir el contenido de las páginas con Flate
+
+    Returns:
+        bytes: Contenido del PDF
+    """
+    objetos = []
+
+    def agregar(contenido):
+        objetos.append(contenido)
+        return len(objetos)
+
+    catalogo = agregar(None)
+    raiz_paginas = agregar(None)
+    fuente = agregar(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>')
+
+    hijos = []
+    for lineas in paginas:
+        flujo = _contenido_pagina(lineas)
+        filtro = b''
+        if comprimir:
+            flujo = zlib.compress(flujo)
+            filtro = b' /Filter /FlateDecode'
+        contenido = agregar(
+            b'<< /Length ' + str(len(flujo)).encode() + filtro + b' >>\nstream\n' + flujo + b'\nendstream'
+        )
+        hijos.append(agregar(
+            f'<< /Type /Page /Parent {raiz_paginas} 0 R /MediaBox [0 0 {ANCHO_PAGINA} {ALTO_PAGINA}] '
+            f'/Resources << /Font << /F1 {fuente} 0 R >> >> /Contents {contenido} 0 R >>'.encode()
+        ))
+
+    objetos[catalogo - 1] = f'<< /Type /Catalog /Pages {raiz_paginas} 0 R >>'.encode()
+    objetos[raiz_paginas - 1] = (
+        f'<< /Type /Pages /Count {len(hijos)} /Kids [' + ' '.join(f'{h} 0 R' for h in hijos) + '] >>'
+    ).encode()
+    info = None
+    if titulo:
+        info = agregar(b'<< /Title (' + _escapar(titulo) + b') >>')
+
+    salida = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    posiciones = []
+    for numero, contenido in enumerate(objetos, start=1):
+        posiciones.append(len(salida))
+        salida += f'{numero} 0 obj\n'.encode() + contenido + b'\nendobj\n'
+
+    inicio_xref = len(salida)
+    salida += f'xref\n0 {len(objetos) + 1}\n0000000000 65535 f \n'.encode()
+    for posicion in posiciones:
+        salida += f'{posicion:010d} 00000 n \n'.encode()
+    trailer = f'<< /Size {len(objetos) + 1} /Root {catalogo} 0 R'
+    if info:
+        trailer += f' /Info {info} 0 R'
+    salida += f'trailer\n{trailer} >>\nstartxref\n{inicio_xref}\n%%EOF\n'.encode()
+    return bytes(salida)
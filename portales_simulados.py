@@ -0,0 +1,146 @@
+# portales_simulados.py
+"""
+Servidor HTTP local que reproduce respuestas grabadas de los portales de
+constancias (RNP, consulta RUC de SUNAT y RNSSC), de la API de DNI de
+apis.net.pe y de la geocodificación inversa de Nominatim.
+
+Uso:
+    python portales_simulados.py [--puerto 8765] [--latencia 0.2] [--carpeta portales_grabados]
+
+y luego apuntar la aplicación al servidor:
+
+    RNP_BASE_URL=http://127.0.0.1:8765
+    SUNAT_RUC_BASE_URL=http://127.0.0.1:8765
+    RNSSC_BASE_URL=http://127.0.0.1:8765
+
+Cada respuesta grabada se describe en `indice.json` con el método, una expresión
+regular sobre la ruta, el archivo con el cuerpo, su tipo y cabeceras extra. En
+cuerpos de texto y cabeceras, `{{PARAMETRO}}` se reemplaza por el valor del
+parámetro de la consulta o del formulario con ese nombre.
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+CARPETA_GRABACIONES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'portales_grabados')
+PATRON_PARAMETRO = re.compile(r'\{\{(\w+)\}\}')
+
+def cargar_grabaciones(carpeta=CARPETA_GRABACIONES):
+    """
+    Lee `indice.json` y los cuerpos de las respuestas grabadas
+    """
+    with open(os.path.join(carpeta, 'indice.json'), encoding='utf-8') as f:
+        indice = json.load(f)
+
+    grabaciones = []
+    for entrada in indice:
+        with open(os.path.join(carpeta, entrada['archivo']), 'rb') as f:
+            cuerpo = f.read()
+        grabaciones.append({
+            'metodo': entrada.get('metodo', 'GET'),
+            'ruta': re.compile(entrada['ruta']),
+            'estado': entrada.get('estado', 200),
+            'tipo': entrada.get('tipo', 'application/octet-stream'),
+            'cabeceras': entrada.get('cabeceras', {}),
+            'cuerpo': cuerpo,
+            'es_texto': entrada.get('tipo', '').startswith(('text/', 'application/json')),
+        })
+    return grabaciones
+
+def _completar(texto, parametros):
+    return PATRON_PARAMETRO.sub(lambda m: parametros.get(m.group(1), m.group(0)), texto)
+
+class ManejadorPortales(BaseHTTPRequestHandler):
+    """
+    Responde cada petición con la primera grabación que coincide
+    """
+    grabaciones = []
+    latencia = 0.0
+    protocol_version = 'HTTP/1.1'
+    # Sin Nagle: cabeceras y cuerpo van en escrituras separadas y, con keep-alive,
+    # el ACK retardado sumaría ~40 ms a cada respuesta
+    disable_nagle_algorithm = True
+
+    def _responder(self, metodo):
+        partes = urlsplit(self.path)
+        parametros = {k: v[0] for k, v in parse_qs(partes.query).items()}
+        longitud = int(self.headers.get('Content-Length') or 0)
+        if longitud:
+            cuerpo = self.rfile.read(longitud).decode('utf-8', errors='replace')
+            parametros.update({k: v[0] for k, v in parse_qs(cuerpo).items()})
+
+        if self.latencia:
+            time.sleep(self.latencia)
+
+        for grabacion in self.grabaciones:
+            if grabacion['metodo'] == metodo and grabacion['ruta'].search(partes.path):
+                break
+        else:
+            self.send_error(404)
+            return
+
+        cuerpo = grabacion['cuerpo']
+        if grabacion['es_texto']:
+            cuerpo = _completar(cuerpo.decode('utf-8'), parametros).encode('utf-8')
+
+        self.send_response(grabacion['estado'])
+        self.send_header('Content-Type', grabacion['tipo'])
+        self.send_header('Content-Length', str(len(cuerpo)))
+        for nombre, valor in grabacion['cabeceras'].items():
+            self.send_header(nombre, _completar(valor, parametros))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def do_GET(self):
+        self._responder('GET')
+
+    def do_POST(self):
+        self._responder('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+def iniciar_servidor(puerto=0, carpeta=CARPETA_GRABACIONES, latencia=0.0):
+    """
+    Inicia el servidor en un hilo de fondo
+
+    Args:
+        puerto: Puerto local (0 elige uno libre)
+        carpeta: Carpeta con `indice.json` y las respuestas grabadas
+        latencia: Demora artificial por petición, en segundos
+
+    Returns:
+        tuple: (servidor, url_base); se detiene con servidor.shutdown()
+    """
+    manejador = type('Manejador', (ManejadorPortales,), {
+        'grabaciones': cargar_grabaciones(carpeta),
+        'latencia': latencia,
+    })
+    servidor = ThreadingHTTPServer(('127.0.0.1', puerto), manejador)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_address[1]}"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Portales de constancias simulados")
+    parser.add_argument('--puerto', type=int, default=8765)
+    parser.add_argument('--latencia', type=float, default=0.0, help="Demora por petición en segundos")
+    parser.add_argument('--carpeta', default=CARPETA_GRABACIONES, help="Carpeta de respuestas grabadas")
+    args = parser.parse_args(argv)
+
+    servidor, url = iniciar_servidor(args.puerto, args.carpeta, args.latencia)
+    print(f"Portales simulados en {url}")
+    for variable in ('RNP_BASE_URL', 'SUNAT_RUC_BASE_URL', 'RNSSC_BASE_URL'):
+        print(f"  {variable}={url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        servidor.shutdown()
+
+if __name__ == "__main__":
+    main()
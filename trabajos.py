@@ -0,0 +1,168 @@
+# trabajos.py
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from cache import compartido
+
+# Trabajos que se ejecutan a la vez y tiempo que se conserva un trabajo terminado
+TRABAJOS_HILOS = int(os.environ.get('TRABAJOS_HILOS', '4'))
+TRABAJOS_TTL = float(os.environ.get('TRABAJOS_TTL', str(30 * 60)))
+
+# Estados de un trabajo
+EN_COLA = 'en_cola'
+EN_CURSO = 'en_curso'
+TERMINADO = 'terminado'
+FALLIDO = 'fallido'
+CANCELADO = 'cancelado'
+
+# Estados de una etapa
+PENDIENTE = 'pendiente'
+HECHA = 'hecha'
+
+class TrabajoCancelado(Exception):
+    """
+    Se lanza entre etapas cuando el usuario canceló el trabajo
+    """
+
+class Trabajo:
+    """
+    Un trabajo en segundo plano dividido en etapas con nombre.
+
+    La función del trabajo marca su avance con `with trabajo.etapa(nombre):`; la
+    cancelación se atiende al empezar cada etapa (una etapa en curso no se
+    interrumpe).
+    """
+    def __init__(self, etapas):
+        self.id = uuid.uuid4().hex
+        self.estado = EN_COLA
+        self.etapas = {nombre: PENDIENTE for nombre in etapas}
+        self.resultado = None
+        self.error = None
+        self.creado = time.time()
+        self.finalizado_en = None
+        self._cancelar = threading.Event()
+        self._futuro = None
+
+    @property
+    def finalizado(self):
+        return self.estado in (TERMINADO, FALLIDO, CANCELADO)
+
+    def progreso(self):
+        """
+        Fracción de etapas terminadas, entre 0 y 1
+        """
+        if not self.etapas:
+            return 1.0 if self.finalizado else 0.0
+        return sum(estado == HECHA for estado in self.etapas.values()) / len(self.etapas)
+
+    def etapa_actual(self):
+        for nombre, estado in self.etapas.items():
+            if estado == EN_CURSO:
+                return nombre
+        return None
+
+    def verificar_cancelacion(self):
+        if self._cancelar.is_set():
+            raise TrabajoCancelado()
+
+    @contextmanager
+    def etapa(self, nombre):
+        self.verificar_cancelacion()
+        self.etapas[nombre] = EN_CURSO
+        try:
+            yield
+        except BaseException:
+            self.etapas[nombre] = FALLIDO
+            raise
+        self.etapas[nombre] = HECHA
+
+    def cancelar(self):
+        self._cancelar.set()
+
+    def __repr__(self):
+        return f"Trabajo({self.id!r}, {self.estado}, {self.progreso():.0%})"
+
+class ColaTrabajos:
+    """
+    Ejecuta trabajos en un pool acotado de hilos y los conserva para consultarlos.
+
+    Los trabajos viven en el proceso y no en la sesión de Streamlit: un rerun no
+    los interrumpe y la página los vuelve a encontrar por su id.
+    """
+    def __init__(self, max_workers=TRABAJOS_HILOS, ttl=TRABAJOS_TTL):
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='trabajos')
+        self._trabajos = {}
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger('trabajos')
+
+    def enviar(self, funcion, etapas, *args, **kwargs):
+        """
+        Encola `funcion(trabajo, *args, **kwargs)` y retorna el id del trabajo
+        """
+        trabajo = Trabajo(etapas)
+        with self._lock:
+            self._purgar()
+            self._trabajos[trabajo.id] = trabajo
+        trabajo._futuro = self._executor.submit(self._ejecutar, trabajo, funcion, args, kwargs)
+        return trabajo.id
+
+    def _ejecutar(self, trabajo, funcion, args, kwargs):
+        estado = FALLIDO
+        try:
+            trabajo.verificar_cancelacion()
+            trabajo.estado = EN_CURSO
+            resultado = funcion(trabajo, *args, **kwargs)
+            # Cancelado durante la última etapa: el resultado ya no se quiere
+            trabajo.verificar_cancelacion()
+            trabajo.resultado = resultado
+            estado = TERMINADO
+        except TrabajoCancelado:
+            estado = CANCELADO
+        except Exception as e:
+            self.logger.error(f"Trabajo {trabajo.id} falló: {e}")
+            trabajo.error = str(e)
+        finally:
+            # Primero la hora: un trabajo finalizado siempre la tiene
+            trabajo.finalizado_en = time.time()
+            trabajo.estado = estado
+
+    def obtener(self, trabajo_id):
+        # Los trabajos vencidos se purgan también al consultar: sus resultados
+        # ocupan memoria aunque nadie envíe trabajos nuevos
+        with self._lock:
+            self._purgar()
+            return self._trabajos.get(trabajo_id)
+
+    def cancelar(self, trabajo_id):
+        """
+        Cancela un trabajo: si aún está en cola no llega a empezar, y si está en
+        curso se detiene antes de su siguiente etapa
+        """
+        trabajo = self.obtener(trabajo_id)
+        if trabajo is None or trabajo.finalizado:
+            return False
+        trabajo.cancelar()
+        if trabajo._futuro is not None and trabajo._futuro.cancel():
+            trabajo.finalizado_en = time.time()
+            trabajo.estado = CANCELADO
+        return True
+
+    def _purgar(self):
+        limite = time.time() - self.ttl
+        for trabajo_id in [
+            t.id for t in self._trabajos.values()
+            if t.finalizado and t.finalizado_en < limite
+        ]:
+            del self._trabajos[trabajo_id]
+
+def cola_trabajos():
+    """
+    Cola de trabajos compartida por todo el proceso
+    """
+    return compartido('cola_trabajos', ColaTrabajos)
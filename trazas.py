@@ -0,0 +1,201 @@
+# trazas.py
+"""
+Trazas por etapa y métricas en formato de texto de Prometheus.
+
+Cada cotización corre dentro de `traza(id)`, que fija un id de correlación, y
+cada etapa dentro de `tramo(nombre)`, que mide con perf_counter, anida los
+tramos y alimenta un histograma de latencias y un contador de errores por etapa.
+
+Las métricas se leen con `exportar_prometheus()`, se sirven en
+http://127.0.0.1:METRICAS_PUERTO/metrics si esa variable está definida, o se
+escriben en un archivo con `escribir_metricas(ruta)`.
+"""
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cache import compartido
+
+# Límites (en segundos) de las cubetas del histograma de latencias
+CUBETAS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Tramos más lentos que esto se informan como advertencia
+TRAMO_LENTO_S = float(os.environ.get('TRAMO_LENTO_S', '5'))
+METRICAS_PUERTO = os.environ.get('METRICAS_PUERTO')
+
+_correlacion = contextvars.ContextVar('correlacion', default=None)
+_ruta_tramo = contextvars.ContextVar('ruta_tramo', default=())
+
+class Metricas:
+    """
+    Histogramas de latencia y contadores de error por etapa, seguros entre hilos
+    """
+    def __init__(self, cubetas=CUBETAS_LATENCIA):
+        self.cubetas = cubetas
+        self._histogramas = {}
+        self._errores = {}
+        self._lock = threading.Lock()
+
+    def observar(self, etapa, segundos, error=False):
+        with self._lock:
+            histograma = self._histogramas.get(etapa)
+            if histograma is None:
+                histograma = self._histogramas[etapa] = {
+                    'cubetas': [0] * len(self.cubetas), 'suma': 0.0, 'cuenta': 0,
+                }
+            for i, limite in enumerate(self.cubetas):
+                if segundos <= limite:
+                    histograma['cubetas'][i] += 1
+            histograma['suma'] += segundos
+            histograma['cuenta'] += 1
+            if error:
+                self._errores[etapa] = self._errores.get(etapa, 0) + 1
+
+    def exportar_prometheus(self):
+        """
+        Métricas en el formato de texto 0.0.4 de Prometheus
+        """
+        lineas = [
+            '# HELP cotizacion_etapa_segundos Duración de cada etapa de la cotización.',
+            '# TYPE cotizacion_etapa_segundos histogram',
+        ]
+        with self._lock:
+            for etapa, histograma in sorted(self._histogramas.items()):
+                for limite, cuenta in zip(self.cubetas, histograma['cubetas']):
+                    lineas.append(f'cotizacion_etapa_segundos_bucket{{etapa="{etapa}",le="{limite:g}"}} {cuenta}')
+                lineas.append(f'cotizacion_etapa_segundos_bucket{{etapa="{etapa}",le="+Inf"}} {histograma["cuenta"]}')
+                lineas.append(f'cotizacion_etapa_segundos_sum{{etapa="{etapa}"}} {histograma["suma"]:.6f}')
+                lineas.append(f'cotizacion_etapa_segundos_count{{etapa="{etapa}"}} {histograma["cuenta"]}')
+
+            lineas.append('# HELP cotizacion_etapa_errores_total Etapas terminadas con error.')
+            lineas.append('# TYPE cotizacion_etapa_errores_total counter')
+            for etapa, cuenta in sorted(self._errores.items()):
+                lineas.append(f'cotizacion_etapa_errores_total{{etapa="{etapa}"}} {cuenta}')
+        return '\n'.join(lineas) + '\n'
+
+    def limpiar(self):
+        with self._lock:
+            self._histogramas.clear()
+            self._errores.clear()
+
+def metricas():
+    """
+    Registro de métricas compartido por todo el proceso
+    """
+    return compartido('metricas', _crear_metricas)
+
+def _crear_metricas():
+    registro = Metricas()
+    if METRICAS_PUERTO:
+        try:
+            servir_metricas(int(METRICAS_PUERTO), registro)
+        except OSError as e:
+            logging.getLogger('trazas').error(f"No se pudo servir métricas en el puerto {METRICAS_PUERTO}: {e}")
+    return registro
+
+def correlacion():
+    """
+    Id de correlación de la traza actual (None fuera de una traza)
+    """
+    return _correlacion.get()
+
+@contextmanager
+def traza(id_correlacion=None, nombre='cotizacion'):
+    """
+    Abre una traza con su id de correlación y un tramo raíz `nombre` (sin
+    tramo raíz si `nombre` es None: solo fija el id)
+    """
+    token = _correlacion.set(id_correlacion or uuid.uuid4().hex)
+    try:
+        if nombre is None:
+            yield _correlacion.get()
+        else:
+            with tramo(nombre):
+                yield _correlacion.get()
+    finally:
+        _correlacion.reset(token)
+
+@contextmanager
+def tramo(nombre):
+    """
+    Mide una etapa. Los tramos se anidan: el registro muestra la ruta completa
+    (cotizacion/constancias/constancia_rnp) y la métrica usa solo `nombre`.
+    """
+    ruta = _ruta_tramo.get() + (nombre,)
+    token = _ruta_tramo.set(ruta)
+    inicio = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        segundos = time.perf_counter() - inicio
+        _ruta_tramo.reset(token)
+        metricas().observar(nombre, segundos, error)
+
+        logger = logging.getLogger('trazas')
+        mensaje = f"[{correlacion() or '-'}] {'/'.join(ruta)} {segundos * 1000:.1f} ms{' ERROR' if error else ''}"
+        if segundos > TRAMO_LENTO_S:
+            logger.warning(mensaje)
+        else:
+            logger.debug(mensaje)
+
+def medido(nombre=None):
+    """
+    Decorador: ejecuta la función dentro de un tramo (por defecto, con su nombre)
+    """
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def wrapper(*args, **kwargs):
+            with tramo(nombre or funcion.__name__):
+                return funcion(*args, **kwargs)
+        return wrapper
+    return decorador
+
+def en_contexto(funcion):
+    """
+    Envuelve `funcion` para ejecutarla en otro hilo con la traza actual
+    (ThreadPoolExecutor no copia los contextvars)
+    """
+    contexto = contextvars.copy_context()
+    return functools.partial(contexto.run, funcion)
+
+def escribir_metricas(ruta, registro=None):
+    """
+    Escribe las métricas en `ruta` (reemplazo atómico, apto para node_exporter)
+    """
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with open(temporal, 'w', encoding='utf-8') as f:
+        f.write((registro or metricas()).exportar_prometheus())
+    os.replace(temporal, ruta)
+
+def servir_metricas(puerto, registro=None):
+    """
+    Sirve las métricas en http://127.0.0.1:`puerto`/metrics desde un hilo de fondo
+    """
+    class Manejador(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            cuerpo = (registro or metricas()).exportar_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def log_message(self, format, *args):
+            pass
+
+    servidor = ThreadingHTTPServer(('127.0.0.1', puerto), Manejador)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name='metricas', daemon=True).start()
+    return servidor